@@ -3,6 +3,8 @@
 from __future__ import with_statement
 import sys
 import socket
+import select
+import errno
 import time
 import traceback
 import pickle
@@ -10,16 +12,48 @@ import struct
 import httplib
 import threading
 import subprocess
+import signal
 import logging
 import random
 import zlib
+from awswire import WIRE_SCHEMA, wire_version, pack_records, unpack_records, encode_message, decode_message, FrameDecoder
 import os
-import signal
+import shutil
+import heapq
+import math
+import Queue
+import uuid
+import re
 
 
 # Customizable params:
 
 DEBUG = False
+recv_size = 65536 # bytes read from the server socket at once
+max_frame_size = 64 * 1024 * 1024 # largest compressed object accepted from the server
+max_object_size = 256 * 1024 * 1024 # largest object accepted from the server once decompressed
+wire_format = 'schema' # 'schema' (compact binary encoding) or 'pickle'; servers predating it get pickle after HELLO
+session_mode = True # keep one connection to the server open and stream records over it (see Commands.SESSION)
+upload_chunk = 96 # records uploaded at once (a day of 15-minute intervals); larger backlogs go in several chunks
+max_concurrent = 64 # HTTP requests to EC2 hosts in flight at once, see ProbeEngine
+warm_probes = True # repeat every request over the kept-alive connection of the first one to time it warm
+keepalive_idle = 30 # seconds an idle kept-alive connection to an EC2 host is kept open
+trace_mode = 'auto' # 'raw' (in-process, needs a raw ICMP socket), 'tracepath' (subprocesses) or 'auto', see PathTracer
+max_traces = 16 # paths traced at once
+trace_max_hops = 30 # farthest hop traced
+trace_window = 4 # hops of a trace probed at once
+trace_gap = 5 # silent hops after the last one which replied before a trace gives up
+trace_wait = 2.0 # seconds to wait for the reply of a hop
+trace_refresh = 6 * 3600 # seconds after which a cached path is traced again even if its spot checks pass
+clock_samples = 32 # last exchanges the offset of the local clock to the server's is estimated from, see ClockSync
+clock_sync_samples = 4 # exchanges made when starting, to estimate the clock offset before the first interval
+session_idle = 3 # request intervals a session may stay silent before the server is taken for gone and it is reopened
+session_clock_int = 10 * 60 # seconds between the clock offset samples taken with the chunks sent over a session
+clock_min_span = 3600 # seconds the samples must span before the drift of the local clock is estimated
+clock_max_drift = 500e-6 # largest drift of the local clock believed, in seconds per second
+clock_wander = 15e-6 # seconds per second the error bound of the clock offset grows by away from its best sample
+spool_dir = 'spool/' # on-disk backlog of the records not yet committed by the server, see RecordSpool
+spool_compact = 4 * 1024 * 1024 # bytes of committed records after which the spool log is rewritten without them
 
 #---------------------------------------------------------------------------------------------------------------------
 
@@ -38,7 +72,30 @@ logging.getLogger('').addHandler(console)
 def enum(**enums):
     return type('Enum', (), enums)
 
-Commands = enum(REFRESH=0x1, SHUTDOWN=0x2, HELLO=0x4, PLANETLAB=0x8, OK=0x16, ERROR=0x32, STATUS=0x64)
+Commands = enum(REFRESH=0x1, SHUTDOWN=0x2, HELLO=0x4, PLANETLAB=0x8, SESSION=0x10, CLOCK=0x20, OK=0x16, ERROR=0x32, STATUS=0x64)
+
+try:
+    recv_into_supported = bytearray is not None # python 2.6+
+except NameError:
+    recv_into_supported = False
+
+try:
+    monotonic = time.monotonic # python 3.3+
+except AttributeError:
+    try:
+        import ctypes
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        clock_gettime = ctypes.CDLL('librt.so.1').clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        def monotonic():
+            """ seconds on the CLOCK_MONOTONIC clock, which the wall clock being set does not move """
+            t = timespec()
+            if clock_gettime(1, ctypes.byref(t)) != 0:
+                raise OSError('clock_gettime failed')
+            return t.tv_sec + t.tv_nsec * 1e-9
+    except (ImportError, OSError, AttributeError):
+        monotonic = time.time
 
 def time2str(time):
     return '%02dm%02ds.%d' % (
@@ -61,7 +118,8 @@ data = {
                     'req2': [start_time, conn_duration, get_duration],
                     'reqN': [start_time, conn_duration, get_duration]
                 },
-                'trace': [start_time, stdout]
+                'trace': [start_time, hops],
+                'clock': [clock_offset, clock_error]
             },
             'ec2host2': {
                 'times': {
@@ -69,15 +127,18 @@ data = {
                     'req2': [start_time, conn_duration, get_duration],
                     'reqN': [start_time, conn_duration, get_duration]
                 },
-                'trace': [start_time, stdout]
+                'trace': [start_time, hops],
+                'clock': [clock_offset, clock_error]
             },
+            ...
             'ec2hostM': {
                 'times': {
                     'req1': [start_time, conn_duration, get_duration],
                     'req2': [start_time, conn_duration, get_duration],
                     'reqN': [start_time, conn_duration, get_duration]
                 },
-                'trace': [start_time, stdout]
+                'trace': [start_time, hops],
+                'clock': [clock_offset, clock_error]
             }
         },
     
@@ -86,66 +147,903 @@ data = {
         // new records are added to the 'records' array
     ]
 }
+
+Timings may carry more values after the first three, see HttpFetch:
+    [start_time, conn_duration, get_duration, dns, connect, first_byte, body, warm_first_byte, warm_body]
+and the path to the EC2 host, traced by PathTracer after the requests, is a list of hops:
+    hops = [[1, address, rtt], [2, address, rtt], ...]
+with None for the address and rtt of hops which did not reply, and for the rtt of hops of a cached
+path which were not checked again; hops is None if the path was not traced. All times are in server
+time: 'clock' is the offset of the local clock the interval was set up with and its error bound, in
+seconds, see ClockSync.
 """
         
 class Probe():
-    def __init__(self, ec2host, req_names, clock_offset, timeout=120):
-        self.record = { 'times': dict(), 'trace': [0, ''] } 
+    """
+    measurements of one EC2 host during an interval; its requests are made by HttpFetch objects on the
+    ProbeEngine thread and its path traced on the PathTracer thread, while end() hands the record over
+    on the thread resetting the interval, so the record is only written under 'lock' and not after end()
+    """
+
+    def __init__(self, ec2host, req_names, clock_offset, clock_error, tracer, timeout=120):
+        self.record = { 'times': dict(), 'trace': [0, None], 'clock': [clock_offset, clock_error] } 
+        self.lock = threading.Lock()
         self.ec2host = ec2host
+        self.hostname = self.ec2host.split('|')[0] #if DEBUG else self.ec2host
+        self.host, self.port = self.hostname, 80
+        if ':' in self.hostname:
+            self.host, self.port = self.hostname.split(':')[0], int(self.hostname.split(':')[1])
+        self.address = None # resolved by the Resolver for the fetches, and traced
         self.req_names = req_names
         self.clock_offset = clock_offset
         self.conn_timeout = float(timeout) / len(req_names) / 2.0
-        self.proc = None
-        
-    def do_probe(self):
-        logging.debug('Starting probe for %s..' % self.ec2host)
-        hostname = self.ec2host.split('|')[0] #if DEBUG else self.ec2host
-        for req_name in self.req_names:
-            try:
-                start_time = time.time()
-                #conn = httplib.HTTPConnection(hostname, timeout=self.conn_timeout)
-                conn = httplib.HTTPConnection(hostname)
-                conn_time = time.time()
-                if req_name[0] != '/':
-                    req_name = '/' + req_name
-                conn.request('GET', req_name)
-                response = conn.getresponse()
-                if response.status == httplib.OK:
-                    data = response.read()
-                    now_time = time.time()
-                    self.record['times'][req_name] = [
-                        start_time - self.clock_offset, 
-                        conn_time - start_time, 
-                        now_time - conn_time
-                    ]
-                    logging.debug('Got http://%s%s %d bytes in %.3fs' % 
-                        (self.ec2host, req_name, len(data), now_time - start_time))
-                else:
-                    logging.debug('ERROR: %s returned %d (%s) for %s' % 
-                        (self.ec2host, response.status, response.reason, req_name))
-                conn.close()
-            except:
-                logging.debug('ERROR: error requesting http://%s%s \n%s' % (self.ec2host, req_name, traceback.format_exc()))
+        self.tracer = tracer
+        self.pending = len(req_names) # requests not finished yet; the path is traced after the last one
+        if warm_probes:
+            self.pending *= 2
+        self.cancelled = False # set once the interval is over
+
+    def set_timing(self, req_name, timing, warm=False):
+        """ stores the timing of a request, or with 'warm' appends it to that of the cold request """
+        self.lock.acquire()
+        try:
+            if self.cancelled:
+                return
+            if not warm:
+                self.record['times'][req_name] = timing
+            elif len(self.record['times'].get(req_name, [])) == 7:
+                self.record['times'][req_name].extend(timing)
+        finally:
+            self.lock.release()
+
+    def fetch_done(self):
+        self.pending -= 1
+        if self.pending > 0:
+            return
+        self.lock.acquire()
         try:
+            if self.cancelled:
+                return
             self.record['trace'][0] = time.time() - self.clock_offset
-            self.proc = subprocess.Popen(['tracepath', '-n', hostname.split(':')[0]], stdout=subprocess.PIPE)
-        except:
-            logging.debug('ERROR: could not complete tracepath command \n%s' % traceback.format_exc())
+        finally:
+            self.lock.release()
+        self.tracer.trace(self)
+
+    def trace_done(self, hops):
+        self.lock.acquire()
+        try:
+            if not self.cancelled:
+                self.record['trace'][1] = hops
+        finally:
+            self.lock.release()
             
     def end(self):
-        if self.proc is not None:
-            if self.proc.poll() is None:
+        self.lock.acquire()
+        try:
+            self.cancelled = True
+            return self.record
+        finally:
+            self.lock.release()
+
+
+class HttpFetch():
+    """
+    one GET request of a probe, made on a non-blocking socket by ProbeEngine, and timed in phases:
+        dns         = name resolution, done ahead by the Resolver (the fetch only waits for it if the
+                      name was never resolved before)
+        connect     = TCP connect
+        first_byte  = sending the request until the first byte of the response
+        body        = the rest of the response
+    and recorded as [start_time, conn_duration (dns + connect), get_duration (dns + connect + first_byte
+    + body, the whole request, as timed by older clients which connected within it), dns, connect,
+    first_byte, body]; a 'warm' fetch repeats the request over the connection kept
+    alive by the first one and appends its own [first_byte, body] to the timing of that request; the body
+    ends after Content-Length bytes, the last chunk of a chunked one, or when the server closes the connection
+    """
+
+    def __init__(self, probe, req_name, warm=False):
+        self.probe = probe
+        self.req_name = req_name
+        if req_name[0] != '/':
+            self.req_name = '/' + req_name
+        self.warm = warm
+        self.sock = None
+        self.state = None # 'resolve', 'connect', 'send' or 'recv'
+        self.head = '' # status line and headers, until completely received
+        self.status = None
+        self.length = None # body length announced by the server, if any
+        self.chunked = False # the body is sent with the chunked transfer encoding
+        self.chunk_left = None # bytes of the current chunk left to read with its CRLF, None at a size line, -1 in the trailer
+        self.pending = '' # chunked body bytes received but not parsed yet
+        self.keepalive = False # the server keeps the connection open after the response
+        self.complete = False # the whole body was read, as delimited by its length or chunks
+        self.size = 0 # body bytes received
+
+    def start(self, engine):
+        self.start_time = time.time() # recorded; the phases are timed on the monotonic clock
+        self.start_clock = monotonic()
+        self.deadline = self.start_clock + self.probe.conn_timeout
+        connection = 'close'
+        if warm_probes:
+            connection = 'keep-alive'
+        self.request = 'GET %s HTTP/1.1\r\nHost: %s\r\nConnection: %s\r\n\r\n' % (self.req_name, self.probe.host, connection)
+        if self.warm:
+            self.sock = engine.take_connection(self.probe.ec2host)
+            if self.sock is None:
+                raise socket.error('no kept-alive connection')
+            self.dns = 0.0
+            self.connect_time = self.conn_time = self.start_clock
+            self.state = 'send'
+            return
+        self.state = 'resolve'
+        self.resolved(engine.resolver.get((self.probe.host, self.probe.port)))
+
+    def resolved(self, lookup):
+        """ connects once the address of the host is known; 'lookup' as returned by Resolver.get() """
+        if lookup is None:
+            return
+        address, self.dns, error = lookup
+        if address is None:
+            raise socket.error('could not resolve %s (%s)' % (self.probe.host, error))
+        self.probe.address = address
+        self.connect_time = monotonic()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(address)
+        if err not in [0, errno.EINPROGRESS, errno.EWOULDBLOCK]:
+            raise socket.error(err, os.strerror(err))
+        self.state = 'connect'
+
+    def writable(self):
+        return self.state in ['connect', 'send']
+
+    def readable(self):
+        return self.state == 'recv'
+
+    def handle_write(self):
+        if self.state == 'connect':
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                raise socket.error(err, os.strerror(err))
+            self.conn_time = monotonic()
+            self.state = 'send'
+        sent = self.sock.send(self.request)
+        self.request = self.request[sent:]
+        if len(self.request) == 0:
+            self.state = 'recv'
+
+    def handle_read(self):
+        """ reads what the server sent; True once the response is complete """
+        data = self.sock.recv(recv_size)
+        if self.status is None:
+            if len(self.head) == 0:
+                self.first_time = monotonic()
+            self.head += data
+            end = self.head.find('\r\n\r\n')
+            if end < 0:
+                if len(data) == 0:
+                    raise socket.error('connection closed before response headers were read')
+                return False
+            lines = self.head[:end].split('\r\n')
+            self.status = int(lines[0].split()[1])
+            self.keepalive = lines[0].startswith('HTTP/1.1')
+            for line in lines[1:]:
+                name, value = line.split(':', 1)
+                name = name.strip().lower()
+                if name == 'content-length':
+                    self.length = int(value.strip())
+                elif name == 'transfer-encoding':
+                    self.chunked = value.strip().lower() != 'identity'
+                elif name == 'connection':
+                    self.keepalive = value.strip().lower() == 'keep-alive' or \
+                        (self.keepalive and value.strip().lower() != 'close')
+            body = self.head[end + 4:]
+            self.head = None
+        else:
+            body = data
+        if len(data) == 0:
+            self.keepalive = False
+            return True
+        if self.chunked:
+            self.complete = self.read_chunks(body)
+        else:
+            self.size += len(body)
+            self.complete = self.length is not None and self.size >= self.length
+        return self.complete
+
+    def read_chunks(self, data):
+        """ parses received bytes of a chunked body; True once its last chunk and trailer are read """
+        self.pending += data
+        while True:
+            if self.chunk_left is None:
+                end = self.pending.find('\r\n')
+                if end < 0:
+                    return False
+                size = int(self.pending[:end].split(';')[0].strip(), 16)
+                self.pending = self.pending[end + 2:]
+                self.chunk_left = -1
+                if size > 0:
+                    self.chunk_left = size + 2
+            if self.chunk_left == -1: # trailer lines, up to an empty one
+                end = self.pending.find('\r\n')
+                if end < 0:
+                    return False
+                line = self.pending[:end]
+                self.pending = self.pending[end + 2:]
+                if len(line) == 0:
+                    return True
+                continue
+            count = min(self.chunk_left, len(self.pending))
+            self.size += max(0, min(count, self.chunk_left - 2))
+            self.chunk_left -= count
+            self.pending = self.pending[count:]
+            if self.chunk_left > 0:
+                return False
+            self.chunk_left = None
+
+    def finish(self, engine):
+        now_time = monotonic()
+        if self.keepalive and self.complete and (len(self.pending) == 0 if self.chunked else self.size == self.length):
+            engine.release_connection(self.probe.ec2host, self.sock)
+            self.sock = None
+        self.close()
+        if self.status == httplib.OK:
+            if not self.warm:
+                self.probe.set_timing(self.req_name, [
+                    self.start_time - self.probe.clock_offset, 
+                    self.dns + self.conn_time - self.connect_time, 
+                    self.dns + now_time - self.connect_time,
+                    self.dns,
+                    self.conn_time - self.connect_time,
+                    self.first_time - self.conn_time,
+                    now_time - self.first_time
+                ])
+            else:
+                self.probe.set_timing(self.req_name, [self.first_time - self.start_clock, now_time - self.first_time], True)
+            logging.debug('Got http://%s%s %d bytes in %.3fs%s' % 
+                (self.probe.ec2host, self.req_name, self.size, now_time - self.start_clock, self.warm and ' (warm)' or ''))
+        else:
+            logging.debug('ERROR: %s returned %d for %s' % (self.probe.ec2host, self.status, self.req_name))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class Resolver(threading.Thread):
+    """
+    looks up the (host, port) names of the EC2 hosts off the ProbeEngine thread, so a slow resolver
+    does not stall the fetches in flight: names are looked up again whenever resolve() is asked to,
+    and the result of the last lookup of each is kept for the fetches to read with get()
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.lookups = dict() # name -> (address or None, seconds the lookup took, error or None)
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.queued = set() # names queued and not looked up yet
+
+    def resolve(self, names):
+        self.lock.acquire()
+        try:
+            for name in names:
+                if name not in self.queued:
+                    self.queued.add(name)
+                    self.queue.put(name)
+        finally:
+            self.lock.release()
+
+    def get(self, name):
+        """ result of the last lookup of 'name', None if it was never looked up """
+        return self.lookups.get(name)
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            name = self.queue.get()
+            if name is None:
+                break
+            self.lock.acquire()
+            try:
+                self.queued.discard(name)
+            finally:
+                self.lock.release()
+            start_clock = monotonic()
+            try:
+                address = socket.getaddrinfo(name[0], name[1], socket.AF_INET, socket.SOCK_STREAM)[0][4]
+                self.lookups[name] = (address, monotonic() - start_clock, None)
+            except:
+                self.lookups[name] = (None, monotonic() - start_clock, str(sys.exc_info()[1]))
+                logging.debug('ERROR: could not resolve %s \n%s' % (name[0], traceback.format_exc()))
+
+
+class ProbeEngine(threading.Thread):
+    """
+    makes the requests of all probes from a single thread: each HttpFetch starts at the monotonic
+    time it was scheduled for, or as soon after as fewer than 'max_concurrent' are in flight, is
+    abandoned once its probe's 'conn_timeout' expires, and all sockets are multiplexed with select();
+    host names are looked up by a Resolver, which fetches of names not looked up yet wait for;
+    with 'warm_probes', a warm fetch follows each cold one and connections kept alive by the EC2 hosts
+    wait in a pool of one connection per host for at most 'keepalive_idle' seconds
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.lock = threading.Lock()
+        self.queue = list() # heap of scheduled (start time, nr, fetch)
+        self.count = 0
+        self.active = list() # fetches in flight
+        self.pool = dict() # ec2host -> (kept-alive connection, time it became idle)
+        self.lag = 0.0 # between the scheduled and actual start of the last fetch
+        self.max_lag = 0.0
+        self.wakeup = os.pipe() # written to when a fetch is scheduled, to interrupt select()
+        self.resolver = Resolver()
+        self.running = True
+
+    def schedule(self, fetch, start_time):
+        self.lock.acquire()
+        try:
+            self.count += 1
+            heapq.heappush(self.queue, (start_time, self.count, fetch))
+        finally:
+            self.lock.release()
+        os.write(self.wakeup[1], 'x')
+
+    def resolve(self, names):
+        """ has the (host, port) 'names' looked up again, ahead of the fetches which need them """
+        self.resolver.resolve(names)
+
+    def stop(self):
+        os.write(self.wakeup[1], 'x')
+        self.running = False
+
+    def get_status(self):
+        return '%d fetches in flight, %d queued, start lag %.3fs (max %.3fs)' % (
+            len(self.active), len(self.queue), self.lag, self.max_lag)
+
+    def take_connection(self, ec2host):
+        """ the kept-alive connection to 'ec2host', if there is one the server has not closed yet """
+        sock, since = self.pool.pop(ec2host, (None, None))
+        if sock is None:
+            return None
+        try:
+            if len(sock.recv(1, socket.MSG_PEEK)) == 0: # closed by the server
+                sock.close()
+                return None
+        except socket.error:
+            if sys.exc_info()[1].args[0] in [errno.EAGAIN, errno.EWOULDBLOCK]: # nothing to read: still open
+                return sock
+            sock.close()
+            return None
+        sock.close() # data nobody asked for
+        return None
+
+    def release_connection(self, ec2host, sock):
+        old_sock, since = self.pool.get(ec2host, (None, None))
+        if old_sock is not None:
+            old_sock.close()
+        self.pool[ec2host] = (sock, monotonic())
+
+    def end_fetch(self, fetch, error=None):
+        if fetch in self.active:
+            self.active.remove(fetch)
+        if error is None:
+            fetch.finish(self)
+        else:
+            fetch.close()
+            logging.debug('ERROR: error requesting http://%s%s (%s)' % (fetch.probe.ec2host, fetch.req_name, error))
+        if warm_probes and not fetch.warm:
+            if error is None and fetch.status == httplib.OK and not fetch.probe.cancelled:
+                self.lock.acquire()
+                try:
+                    self.count += 1
+                    heapq.heappush(self.queue, (monotonic(), self.count, HttpFetch(fetch.probe, fetch.req_name, True)))
+                finally:
+                    self.lock.release()
+            else: # nothing to repeat warm: count the warm fetch as done too
+                fetch.probe.fetch_done()
+        fetch.probe.fetch_done()
+
+    def run(self):
+        self.resolver.start()
+        while self.running:
+            clock = monotonic()
+            # start the fetches which are due
+            self.lock.acquire()
+            try:
+                due = list()
+                while len(self.queue) > 0 and self.queue[0][0] <= clock and len(self.active) + len(due) < max_concurrent:
+                    due.append(heapq.heappop(self.queue))
+                next_start = None
+                if len(self.queue) > 0:
+                    next_start = self.queue[0][0]
+            finally:
+                self.lock.release()
+            for start_time, nr, fetch in due:
+                if fetch.probe.cancelled:
+                    continue
+                self.lag = clock - start_time
+                self.max_lag = max(self.max_lag, self.lag)
+                try:
+                    fetch.start(self)
+                    self.active.append(fetch)
+                except:
+                    self.end_fetch(fetch, traceback.format_exc())
+            resolving = False
+            for fetch in list(self.active):
+                if fetch.state == 'resolve':
+                    try:
+                        fetch.resolved(self.resolver.get((fetch.probe.host, fetch.probe.port)))
+                        resolving = resolving or fetch.state == 'resolve'
+                    except:
+                        self.end_fetch(fetch, traceback.format_exc())
+            # drop the fetches of ended probes and those taking too long
+            for fetch in list(self.active):
+                if fetch.probe.cancelled:
+                    self.active.remove(fetch)
+                    fetch.close()
+                elif clock > fetch.deadline:
+                    self.end_fetch(fetch, 'timed out')
+            for ec2host, (sock, since) in list(self.pool.items()):
+                if clock - since > keepalive_idle:
+                    sock.close()
+                    del self.pool[ec2host]
+            wait = 1.0
+            if next_start is not None and len(self.active) < max_concurrent:
+                wait = min(wait, next_start - clock)
+            for fetch in self.active:
+                wait = min(wait, fetch.deadline - clock)
+            if resolving: # poll for the lookups the resolver has not finished yet
+                wait = min(wait, 0.01)
+            readers = [self.wakeup[0]] + [fetch.sock for fetch in self.active if fetch.readable()]
+            writers = [fetch.sock for fetch in self.active if fetch.writable()]
+            try:
+                readable, writable, failed = select.select(readers, writers, [], max(0, wait))
+            except select.error:
+                continue
+            if self.wakeup[0] in readable:
+                os.read(self.wakeup[0], 4096)
+            for fetch in list(self.active):
                 try:
-                    #self.proc.terminate()
-                    os.kill(self.proc.pid, signal.SIGTERM)
+                    if fetch.sock in writable:
+                        fetch.handle_write()
+                    elif fetch.sock in readable and fetch.handle_read():
+                        self.end_fetch(fetch)
                 except:
-                    logging.debug('ERROR: failed stopping tracepath \n%s' % traceback.format_exc())
+                    self.end_fetch(fetch, traceback.format_exc())
+        for fetch in self.active:
+            fetch.close()
+        for sock, since in self.pool.values():
+            sock.close()
+        self.resolver.stop()
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+
+
+tracepath_line = re.compile(r'^\s*(\d+)\??:\s+(\S+)(.*)$')
+tracepath_rtt = re.compile(r'([0-9.]+)ms')
+
+def parse_tracepath(output):
+    """ hop list of the output of 'tracepath -n' """
+    hops = dict()
+    for line in output.splitlines():
+        match = tracepath_line.match(line)
+        if match is None:
+            continue
+        hop, addr, rest = int(match.group(1)), match.group(2), match.group(3)
+        rtt = None
+        if addr == 'no': # no reply
+            addr = None
+        elif not addr[0].isdigit(): # [LOCALHOST] and errors
+            continue
+        else:
+            match = tracepath_rtt.search(rest)
+            if match is not None:
+                rtt = float(match.group(1)) / 1000
+        if hops.get(hop, [hop, None, None])[1] is None: # keep the first reply of a hop
+            hops[hop] = [hop, addr, rtt]
+    return [hops[hop] for hop in sorted(hops.keys())]
+
+
+class Trace():
+    """ path discovery towards the EC2 host of a probe, or a spot check of its cached path """
+
+    def __init__(self, probe, addr, cached=None):
+        self.probe = probe
+        self.addr = addr
+        self.cached = cached # hops of the cached path, when only some of them are probed
+        if cached is None:
+            self.ttls = range(1, trace_max_hops + 1) # hops left to probe
+        else:
+            answered = [hop for hop, hop_addr, rtt in cached[:-1] if hop_addr is not None]
+            self.ttls = [cached[-1][0]]
+            if len(answered) > 0:
+                self.ttls.insert(0, random.choice(answered))
+        self.replies = dict() # hop -> [hop, address, rtt]
+        self.in_flight = 0
+        self.last_reply = 0 # farthest hop which replied
+        self.reached = None # hop at which the EC2 host, or an unreachable error, answered
+        self.proc = None # tracepath subprocess
+        self.output = ''
+
+    def can_send(self):
+        if len(self.ttls) == 0 or self.in_flight >= trace_window:
+            return False
+        if self.cached is not None:
+            return True
+        ttl = self.ttls[0]
+        return (self.reached is None or ttl < self.reached) and ttl <= self.last_reply + trace_gap
+
+    def reply(self, ttl, addr, rtt, final=False):
+        self.in_flight -= 1
+        self.replies[ttl] = [ttl, addr, rtt]
+        if addr is not None:
+            self.last_reply = max(self.last_reply, ttl)
+        if final and (self.reached is None or ttl < self.reached):
+            self.reached = ttl
+
+    def done(self):
+        return self.in_flight == 0 and not self.can_send()
+
+    def hops(self):
+        """ hops of a full trace, up to the EC2 host or the last hop which replied """
+        end = self.reached or self.last_reply
+        return [self.replies.get(ttl, [ttl, None, None]) for ttl in range(1, end + 1)]
+
+    def path_changed(self):
+        """ whether the spot-checked hops disagree with the cached path """
+        cached = dict([(hop, addr) for hop, addr, rtt in self.cached])
+        answered = False
+        for hop, addr, rtt in self.replies.values():
+            if addr is not None:
+                answered = True
+                if addr != cached.get(hop):
+                    return True
+        return not answered
+
+    def checked_hops(self):
+        """ the cached path, with the round trip times of the spot-checked hops """
+        return [[hop, addr, self.replies.get(hop, [hop, None, None])[2]] for hop, addr, rtt in self.cached]
+
+
+class PathTracer(threading.Thread):
+    """
+    traces the path to the EC2 host of every probe whose requests are done, at most 'max_traces' at
+    once, from a single thread: UDP datagrams are sent with increasing TTLs, 'trace_window' hops of a
+    trace at a time, and the ICMP time exceeded and port unreachable errors they cause are read from
+    a raw socket. A path traced less than 'trace_refresh' seconds ago is only spot-checked at its last
+    hop and one other, and traced again if they answer from other addresses or not at all. Where raw
+    sockets are not permitted, tracepath subprocesses are run instead and their output is parsed.
+    """
+
+    base_port = 33434 # destination ports of the datagrams, one per hop in flight
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.lock = threading.Lock()
+        self.queue = list() # probes waiting to be traced
+        self.traces = list() # traces in progress
+        self.paths = dict() # address -> (hops, time traced)
+        self.sent = dict() # port -> (trace, ttl, send time) of datagrams not answered yet
+        self.port_nr = 0
+        self.icmp = None
+        if trace_mode != 'tracepath':
+            try:
+                self.icmp = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+                self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.udp.bind(('', 0))
+                self.udp_port = self.udp.getsockname()[1]
+            except socket.error:
+                logging.info('ERROR: could not open raw ICMP socket, tracing paths with tracepath instead \n%s' %
+                    traceback.format_exc())
+                if self.icmp is not None:
+                    self.icmp.close()
+                    self.icmp = None
+        self.wakeup = os.pipe() # written to when a probe is queued, to interrupt select()
+        self.running = True
+
+    def trace(self, probe):
+        self.lock.acquire()
+        try:
+            self.queue.append(probe)
+        finally:
+            self.lock.release()
+        os.write(self.wakeup[1], 'x')
+
+    def stop(self):
+        os.write(self.wakeup[1], 'x')
+        self.running = False
+
+    def start_trace(self, probe, addr=None, cached=None):
+        try:
+            if addr is None: # as resolved for the fetches, so the tracer never waits for a lookup
+                if probe.address is None:
+                    raise socket.error('%s was not resolved' % probe.host)
+                addr = probe.address[0]
+            if self.icmp is None:
+                trace = Trace(probe, addr)
+                trace.proc = subprocess.Popen(['tracepath', '-n', addr], stdout=subprocess.PIPE)
             else:
+                path = self.paths.get(addr)
+                if cached is None and path is not None and time.time() - path[1] < trace_refresh:
+                    cached = path[0]
+                trace = Trace(probe, addr, cached)
+        except:
+            logging.debug('ERROR: could not trace path to %s \n%s' % (probe.hostname, traceback.format_exc()))
+            probe.trace_done([])
+            return
+        self.traces.append(trace)
+        if self.icmp is not None:
+            self.send_hops(trace)
+
+    def send_hops(self, trace):
+        while trace.can_send():
+            ttl = trace.ttls.pop(0)
+            while True:
+                self.port_nr = (self.port_nr + 1) % 4096
+                port = self.base_port + self.port_nr
+                if port not in self.sent:
+                    break
+            try:
+                self.udp.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+                self.udp.sendto('', (trace.addr, port))
+            except socket.error:
+                logging.debug('ERROR: could not probe hop %d towards %s \n%s' % (ttl, trace.addr, traceback.format_exc()))
+                trace.replies[ttl] = [ttl, None, None]
+                continue
+            self.sent[port] = (trace, ttl, time.time())
+            trace.in_flight += 1
+        if trace.done():
+            self.end_trace(trace)
+
+    def handle_icmp(self):
+        packet, address = self.icmp.recvfrom(recv_size)
+        now = time.time()
+        header = (ord(packet[0]) & 0x0F) * 4
+        if len(packet) < header + 8 + 20 + 4 or ord(packet[header]) not in [3, 11]: # unreachable, time exceeded
+            return
+        inner = header + 8 # the header of our datagram, quoted by the error
+        inner_header = (ord(packet[inner]) & 0x0F) * 4
+        if ord(packet[inner + 9]) != socket.IPPROTO_UDP or len(packet) < inner + inner_header + 4:
+            return
+        src_port, dst_port = struct.unpack('!HH', packet[inner + inner_header:inner + inner_header + 4])
+        dst = socket.inet_ntoa(packet[inner + 16:inner + 20])
+        sent = self.sent.get(dst_port)
+        if src_port != self.udp_port or sent is None or sent[0].addr != dst:
+            return
+        del self.sent[dst_port]
+        trace, ttl, send_time = sent
+        trace.reply(ttl, address[0], now - send_time, ord(packet[header]) == 3)
+        self.send_hops(trace)
+
+    def end_trace(self, trace):
+        self.traces.remove(trace)
+        if trace.probe.cancelled:
+            return
+        if trace.proc is not None:
+            hops = parse_tracepath(trace.output)
+        elif trace.cached is None:
+            hops = trace.hops()
+            if trace.last_reply > 0:
+                self.paths[trace.addr] = (hops, time.time())
+        elif trace.path_changed():
+            logging.debug('Path to %s changed, tracing it again' % trace.addr)
+            self.paths.pop(trace.addr, None) # spot checks of another trace may have dropped it already
+            self.start_trace(trace.probe, trace.addr)
+            return
+        else:
+            hops = trace.checked_hops()
+        trace.probe.trace_done(hops)
+
+    def fail_trace(self, trace):
+        """ gives up on a trace which raised an error, so that it does not stop the tracer """
+        logging.debug('ERROR: failed tracing path to %s \n%s' % (trace.addr, traceback.format_exc()))
+        if trace in self.traces:
+            self.drop_trace(trace)
+            trace.probe.trace_done([])
+
+    def drop_trace(self, trace):
+        self.traces.remove(trace)
+        for port, (sent_trace, ttl, send_time) in list(self.sent.items()):
+            if sent_trace is trace:
+                del self.sent[port]
+        if trace.proc is not None and trace.proc.poll() is None:
+            try:
+                os.kill(trace.proc.pid, signal.SIGTERM)
+            except:
+                logging.debug('ERROR: failed stopping tracepath \n%s' % traceback.format_exc())
+        if trace.proc is not None:
+            trace.proc.stdout.close()
+            trace.proc.wait()
+
+    def run(self):
+        while self.running:
+            # start tracing the queued probes
+            self.lock.acquire()
+            try:
+                queued = self.queue[:max(0, max_traces - len(self.traces))]
+                del self.queue[:len(queued)]
+            finally:
+                self.lock.release()
+            for probe in queued:
+                if not probe.cancelled:
+                    self.start_trace(probe)
+            # drop the traces of ended probes and give up on hops which did not answer in time
+            for trace in list(self.traces):
+                if trace.probe.cancelled:
+                    self.drop_trace(trace)
+            now = time.time()
+            wait = 1.0
+            for port, (trace, ttl, send_time) in list(self.sent.items()):
+                if now - send_time > trace_wait:
+                    del self.sent[port]
+                    try:
+                        trace.reply(ttl, None, None)
+                        self.send_hops(trace)
+                    except:
+                        self.fail_trace(trace)
+                else:
+                    wait = min(wait, send_time + trace_wait - now)
+            readers = [self.wakeup[0]] + [trace.proc.stdout for trace in self.traces if trace.proc is not None]
+            if self.icmp is not None:
+                readers.append(self.icmp)
+            try:
+                readable, writable, failed = select.select(readers, [], [], max(0, wait))
+            except select.error:
+                continue
+            if self.wakeup[0] in readable:
+                os.read(self.wakeup[0], 4096)
+            if self.icmp is not None and self.icmp in readable:
+                try:
+                    self.handle_icmp()
+                except:
+                    logging.debug('ERROR: failed reading ICMP reply \n%s' % traceback.format_exc())
+            for trace in list(self.traces):
+                if trace.proc is not None and trace.proc.stdout in readable:
+                    try:
+                        data = os.read(trace.proc.stdout.fileno(), recv_size)
+                        trace.output += data
+                        if len(data) == 0:
+                            trace.proc.stdout.close()
+                            trace.proc.wait()
+                            self.end_trace(trace)
+                    except:
+                        self.fail_trace(trace)
+        for trace in list(self.traces):
+            self.drop_trace(trace)
+        if self.icmp is not None:
+            self.icmp.close()
+            self.udp.close()
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+
+
+class Scheduler(threading.Thread):
+    """
+    runs the tasks of a node at their due times on the monotonic clock, one after the other from a
+    single thread; tasks must not block, and the lag between the due time of a task and the time it
+    ran is tracked
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.lock = threading.Lock()
+        self.queue = list() # heap of (due time, nr, task, args)
+        self.count = 0
+        self.wakeup = os.pipe() # written to when a task is scheduled, to interrupt select()
+        self.running = True
+        self.runs = 0
+        self.lag = 0.0 # of the last task run
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    def schedule(self, due, task, *args):
+        self.lock.acquire()
+        try:
+            self.count += 1
+            heapq.heappush(self.queue, (due, self.count, task, args))
+        finally:
+            self.lock.release()
+        os.write(self.wakeup[1], 'x')
+
+    def stop(self):
+        os.write(self.wakeup[1], 'x')
+        self.running = False
+
+    def run(self):
+        while self.running:
+            self.lock.acquire()
+            try:
+                due = list()
+                while len(self.queue) > 0 and self.queue[0][0] <= monotonic():
+                    due.append(heapq.heappop(self.queue))
+                wait = 60.0
+                if len(self.queue) > 0:
+                    wait = min(wait, self.queue[0][0] - monotonic())
+            finally:
+                self.lock.release()
+            for due_time, nr, task, args in due:
+                if not self.running:
+                    break
+                self.lag = monotonic() - due_time
+                self.max_lag = max(self.max_lag, self.lag)
+                self.total_lag += self.lag
+                self.runs += 1
                 try:
-                    self.record['trace'][1] = self.proc.communicate()[0]
+                    task(*args)
                 except:
-                    logging.debug('ERROR: failed getting tracepath output \n%s' % traceback.format_exc())
-        return self.record
+                    logging.info('ERROR: scheduled task failed \n%s' % traceback.format_exc())
+            if len(due) > 0:
+                continue
+            try:
+                readable, writable, failed = select.select([self.wakeup[0]], [], [], max(0, wait))
+            except select.error:
+                continue
+            if self.wakeup[0] in readable:
+                os.read(self.wakeup[0], 4096)
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+
+    def get_status(self):
+        return '%d tasks run, lag %.3fs (avg %.3fs, max %.3fs)' % (
+            self.runs, self.lag, self.total_lag / max(1, self.runs), self.max_lag)
+
+
+class ClockSync():
+    """
+    NTP-style estimate of the offset of the local clock from the server's (local - server time). Each
+    exchange is a sample, as is a session chunk carrying the time it was 'sent' at every 'session_clock_int'
+    seconds: the greeting or chunk is sent at local time t0 and received by the server at t1 ('recv' in
+    node_info or the clock reply), which replies at t2 ('now') and the reply is received at local time t3, so
+        offset = ((t0 - t1) + (t3 - t2)) / 2, within delay / 2 of the truth
+        delay  = (t3 - t0) - (t2 - t1)
+    Of the last 'clock_samples' samples, the half with the lowest delays is kept (queueing only ever
+    adds delay, and asymmetric error with it) and, once they span 'clock_min_span' seconds, a line
+    fitted through them tracks the drift of the local clock. The error bound is half the delay of the
+    best sample, plus how far the fit strays from it, plus 'clock_wander' per second the estimate is
+    extrapolated over, from the best sample or, with a fit, from the last sample kept.
+    """
+
+    def __init__(self):
+        self.samples = list() # (local time, offset, delay)
+
+    def add(self, sent, recv, now, received):
+        if recv is None: # servers predating 'recv' reply as soon as they receive the greeting
+            recv = now
+        offset = ((sent - recv) + (received - now)) / 2.0
+        delay = max(0.0, (received - sent) - (now - recv))
+        self.samples.append((received, offset, delay))
+        del self.samples[:-clock_samples]
+        logging.debug('Clock offset sample %.6fs (delay %.6fs)' % (offset, delay))
+
+    def get_estimate(self, now=None):
+        """ (offset, error bound) of the local clock at local time 'now' """
+        if now is None:
+            now = time.time()
+        good = sorted(self.samples, key=lambda sample: sample[2])[:(len(self.samples) + 1) // 2]
+        best_time, best_offset, best_delay = good[0]
+        base_time, base_offset, drift = best_time, best_offset, 0.0
+        since = best_time # the estimate is extrapolated from
+        times = [sample[0] for sample in good]
+        if len(good) >= 2 and max(times) - min(times) >= clock_min_span:
+            base_time = sum(times) / len(good)
+            base_offset = sum([sample[1] for sample in good]) / len(good)
+            variance = sum([(sample[0] - base_time) ** 2 for sample in good])
+            covariance = sum([(sample[0] - base_time) * (sample[1] - base_offset) for sample in good])
+            drift = max(-clock_max_drift, min(clock_max_drift, covariance / variance))
+            since = max(times)
+        offset = base_offset + drift * (now - base_time)
+        error = best_delay / 2 + abs(base_offset + drift * (best_time - base_time) - best_offset) + \
+            clock_wander * abs(now - since)
+        return offset, error
 
 #---------------------------------------------------------------------------------------------------------------------
 
@@ -158,25 +1056,110 @@ SERVER <-> PLANETLAB_NODE protocol:
                     greeting
     OK
     node_info
-                    records
+                    chunk           (seq, records)
     OK
-    <close>
-                    <clear_records>
+                    <clear_chunk>
+                    ...             (chunk and OK until all records are committed)
                     <close>            
+
+    SERVER          CLIENT (session mode)
+    ------          ------
+                    SESSION
+                    greeting
+    OK
+    node_info
+                    PLANETLAB
+                    chunk
+    OK
+    CLOCK                           (if the chunk carries the time it was 'sent' at)
+    clock           (sent, recv, now)
+                    <clear_chunk>
+                    ...             (PLANETLAB, chunk and OK while records are collected)
+    REFRESH
+    node_info       (whenever the server configuration is refreshed)
+                    ...
+
+PLANETLAB, SESSION and HELLO carry the WIRE_SCHEMA flag when the objects that follow use the schema
+wire format; inside a session the format chosen by SESSION is used. Records are numbered within the
+node's upload stream, named in the greeting: a chunk carries the number 'seq' of its first record and
+node_info the number 'committed' of the first record the server has not stored yet, so chunks whose
+acknowledgement was lost are dropped instead of being sent, or stored, twice.
+
+Greetings and session chunks carry the 'probe_times' the requests to each EC2 host took in the last
+interval; the server may answer them with another slot and delta, in node_info or, in a session, in a
+REFRESH push, to keep the requests in flight against each EC2 host under its ceiling.
 """
 
 class Node():
-    def __init__(self, sock_handler):
+    def __init__(self, sock_handler, spool=None):
         self.handler = sock_handler
         self.id = None
         self.running = False
-        self.records = list()
+        if spool is None:
+            spool = RecordSpool(spool_dir)
+        self.spool = spool # records not yet committed by the server
         self.probes = None
-        self.probe_timers = None
-        self.reset_timer = None
-        self.last_probing = None
+        self.engine = None # ProbeEngine making the requests of the probes, while running
+        self.tracer = None # PathTracer tracing the paths to the EC2 hosts, while running
+        self.scheduler = None # Scheduler running the resets of the intervals, while running
+        self.uploads = None # queue of the uploads for the upload thread, while running
+        self.interval_end = None # server time at which the current interval ends
+        self.grid = None # (delta, req_int) the current interval was set up with
+        self.probe_times = None # average seconds the requests to each EC2 host took in the last interval
+        self.clock = ClockSync() # estimate of the offset of the local clock from the server's
+        self.clock_offset = None
+        self.clock_error = None
+        self.drift = 0.0 # of the last reset from the end of its interval
+        self.max_drift = 0.0
         self.hostname = socket.gethostname()
+        self.lock = threading.RLock() # guards 'spool' and 'in_flight'
+        self.in_flight = None # end sequence number of the chunk sent over the session and not yet acknowledged
+        self.clock_sampled = None # monotonic time of the last chunk sent over the session as a clock sample
         
+    def __apply_node_info(self, reply, sent=None):
+        """ 'sent' is the local time the greeting answered by 'reply' was sent at, None for pushes """
+        received = time.time()
+        logging.debug('Received %s' % reply)
+        self.id = reply['id']
+        self.slot = reply['slot']
+        self.delta = reply['delta']
+        self.req_int = reply['req_int']
+        self.ec2hosts = reply['ec2hosts']
+        self.req_names = reply['req_names']
+        if sent is not None:
+            self.__add_clock_sample(sent, reply.get('recv'), reply['now'], received)
+        self.__drop_records(reply.get('committed'))
+
+    def __add_clock_sample(self, sent, recv, now, received):
+        self.clock.add(sent, recv, now, received)
+        self.clock_offset, self.clock_error = self.clock.get_estimate(received)
+        logging.debug('Clock offset %.6fs (error %.6fs)' % (self.clock_offset, self.clock_error))
+
+    def __drop_records(self, seq):
+        """ forgets the records before sequence number 'seq', which the server has committed """
+        if seq is None:
+            return
+        self.lock.acquire()
+        try:
+            self.spool.commit(seq)
+        finally:
+            self.lock.release()
+
+    def __get_chunk(self):
+        """ the oldest records not yet committed by the server, at most 'upload_chunk' of them """
+        self.lock.acquire()
+        try:
+            return self.spool.read(upload_chunk)
+        finally:
+            self.lock.release()
+
+    def __add_record(self, record):
+        self.lock.acquire()
+        try:
+            self.spool.append(record)
+        finally:
+            self.lock.release()
+
     def __do_hello(self):
         logging.debug('Attempting to register at server at %s..' % self.handler.str_address)
         self.id = None
@@ -189,23 +1172,25 @@ class Node():
         self.handler.connect()
         if not self.handler.connected:
             return
-        self.handler.send_command(Commands.HELLO)
+        self.handler.send_command(Commands.HELLO | self.handler.wire_flags)
         greeting = {
             'hostname': self.hostname
         }
-        self.handler.send_object(greeting)
+        sent = time.time()
+        self.handler.send_object(greeting, 'greeting')
         code = self.handler.recv_command()
+        if code is None and self.handler.wire_flags & WIRE_SCHEMA:
+            # servers predating the schema wire format close the connection on a flagged command
+            logging.info('Server closed the connection after HELLO, retrying with the pickle wire format..')
+            self.handler.wire_flags = 0
+            self.__do_hello()
+            if self.id is None: # the server may just have been unreachable
+                self.handler.wire_flags = WIRE_SCHEMA
+            return
         if code == Commands.OK:
-            reply = self.handler.recv_object()
+            reply = self.handler.recv_object('node_info')
             if reply is not None:
-                logging.debug('Received %s' % reply)
-                self.id = reply['id']
-                self.slot = reply['slot']
-                self.delta = reply['delta']
-                self.req_int = reply['req_int']
-                self.ec2hosts = reply['ec2hosts']
-                self.req_names = reply['req_names']
-                self.clock_offset = time.time() - reply['now']
+                self.__apply_node_info(reply, sent)
         else:
             if code == Commands.ERROR:
                 logging.info('ERROR: server returned ERROR code after sending HELLO message')
@@ -216,77 +1201,224 @@ class Node():
         self.handler.connect()
         if not self.handler.connected:
             return
-        self.handler.send_command(Commands.PLANETLAB)
+        self.handler.send_command(Commands.PLANETLAB | self.handler.wire_flags)
         greeting = {
             'id': self.id,
             'slot': self.slot,            
-            'hostname': self.hostname
+            'hostname': self.hostname,
+            'stream': self.spool.stream,
+            'probe_times': self.probe_times
         }
-        self.handler.send_object(greeting)
+        sent = time.time()
+        self.handler.send_object(greeting, 'greeting')
         code = self.handler.recv_command()
         if code == Commands.OK:
-            reply = self.handler.recv_object()
+            reply = self.handler.recv_object('node_info')
             if reply is not None:
-                logging.debug('Received %s' % reply)
-                self.id = reply['id']
-                self.slot = reply['slot']
-                self.delta = reply['delta']
-                self.req_int = reply['req_int']
-                self.ec2hosts = reply['ec2hosts']
-                self.req_names = reply['req_names']
-                self.clock_offset = time.time() - reply['now']
-                data = {
-                    'records': self.records
-                }
-                self.handler.send_object(data)
-                code = self.handler.recv_command()
-                if code == Commands.OK:
-                    self.records = list()
-                else:
-                    if code == Commands.ERROR:
-                        logging.info('ERROR: server returned ERROR code after sending data')
+                self.__apply_node_info(reply, sent)
+                while self.handler.connected:
+                    chunk = self.__get_chunk()
+                    if len(chunk['records']) == 0:
+                        break
+                    self.handler.send_object(chunk, 'data')
+                    code = self.handler.recv_command()
+                    if code == Commands.OK:
+                        self.__drop_records(chunk['seq'] + len(chunk['records']))
+                    else:
+                        if code == Commands.ERROR:
+                            logging.info('ERROR: server returned ERROR code after sending data')
+                        break
         else:
             if code == Commands.ERROR:
                 logging.info('ERROR: server returned ERROR code after greeting')
         self.handler.close()
     
+    def __open_session(self):
+        """ connects to the server in session mode and starts reading from the session """
+        logging.debug('Opening session with server at %s..' % self.handler.str_address)
+        self.handler.connect()
+        if not self.handler.connected:
+            return False
+        # the server acknowledges a chunk every interval, so a longer silence means a half-open connection
+        self.handler.sock.settimeout(session_idle * self.req_int)
+        self.handler.send_command(Commands.SESSION | self.handler.wire_flags)
+        greeting = {
+            'id': self.id,
+            'slot': self.slot,
+            'hostname': self.hostname,
+            'stream': self.spool.stream,
+            'probe_times': self.probe_times
+        }
+        sent = time.time()
+        self.handler.send_object(greeting, 'greeting')
+        code = self.handler.recv_command()
+        if code == Commands.OK:
+            reply = self.handler.recv_object('node_info')
+            if reply is not None:
+                self.__apply_node_info(reply, sent)
+                reader = threading.Thread(target=self.__read_session)
+                reader.setDaemon(True)
+                reader.start()
+                return True
+        else:
+            if code == Commands.ERROR:
+                logging.info('ERROR: server returned ERROR code after session greeting')
+        self.handler.close()
+        return False
+
+    def __read_session(self):
+        """ handles what the server sends over the session: batch acknowledgements, clock samples and node info pushes """
+        while self.handler.connected:
+            code = self.handler.recv_command()
+            if code == Commands.OK:
+                self.lock.acquire()
+                try:
+                    self.__drop_records(self.in_flight)
+                    self.in_flight = None
+                finally:
+                    self.lock.release()
+                uploads = self.uploads
+                if uploads is not None and uploads.empty(): # keep draining the backlog
+                    uploads.put(self.__do_session)
+            elif code == Commands.ERROR:
+                logging.info('ERROR: server returned ERROR code after sending data')
+                self.__clear_in_flight()
+            elif code == Commands.CLOCK:
+                reply = self.handler.recv_object('clock')
+                if reply is not None:
+                    self.__add_clock_sample(reply['sent'], reply['recv'], reply['now'], time.time())
+            elif code == Commands.REFRESH:
+                reply = self.handler.recv_object('node_info')
+                if reply is not None:
+                    self.__apply_node_info(reply)
+            elif code is not None:
+                logging.debug('ERROR: unexpected command %s in session' % code)
+                self.handler.close()
+        self.__clear_in_flight()
+        logging.debug('Session with server closed')
+        uploads = self.uploads
+        if self.running and uploads is not None and uploads.empty(): # reopen it, or fall back to exchanges, right away
+            uploads.put(self.__do_session)
+
+    def __clear_in_flight(self):
+        """ forgets the chunk in flight, which is sent again with the next one """
+        self.lock.acquire()
+        try:
+            self.in_flight = None
+        finally:
+            self.lock.release()
+
+    def __do_session(self):
+        """
+        sends the next chunk of records not yet committed over the session, opening it if needed; runs
+        on the upload thread only, and sends without holding the lock, so a slow socket does not hold
+        up the resets of the intervals
+        """
+        if not self.handler.connected and not self.__open_session():
+            self.__do_exchange() # the server may not support sessions
+            return
+        chunk = self.__claim_chunk()
+        if chunk is not None:
+            clock = monotonic()
+            if self.clock_sampled is None or clock - self.clock_sampled >= session_clock_int:
+                self.clock_sampled = clock
+                chunk['sent'] = time.time()
+            self.handler.send_command(Commands.PLANETLAB)
+            self.handler.send_object(chunk, 'data')
+
+    def __claim_chunk(self):
+        """ the next chunk to send over the session, None while one is in flight or if none is left """
+        self.lock.acquire()
+        try:
+            if self.in_flight is not None:
+                return None
+            chunk = self.__get_chunk()
+            if len(chunk['records']) == 0:
+                return None
+            chunk['probe_times'] = self.probe_times
+            self.in_flight = chunk['seq'] + len(chunk['records'])
+            return chunk
+        finally:
+            self.lock.release()
+
     def __setup(self):
         if not self.running:
             return
+        self.clock_offset, self.clock_error = self.clock.get_estimate()
         now = time.time() - self.clock_offset
-        last_setup = self.last_probing
-        self.last_probing = now
-        init_delay = self.req_int - (float(int(now * 1000) % int(self.req_int * 1000)) / 1000) + self.delta
-        while init_delay >= self.req_int:
-            init_delay -= self.req_int
-        if last_setup is None:
-            logging.debug('Probes will start in %s' % time2str(init_delay))
+        clock = monotonic()
+        # intervals start at multiples of req_int shifted by delta, in server time: the first one at the
+        # next such time, later ones at the nearest, so resets do not drift however late they run (but
+        # at the next one again if the server moved the node, rather than making the first requests at once)
+        intervals = (now - self.delta) / self.req_int
+        if self.interval_end is None or self.grid != (self.delta, self.req_int):
+            interval_start = math.ceil(intervals) * self.req_int + self.delta
+            logging.debug('Probes will start in %s' % time2str(interval_start - now))
         else:
+            interval_start = round(intervals) * self.req_int + self.delta
             logging.debug('Setting up probes..')
-            if (now + init_delay - last_setup) > self.req_int:
-                init_delay -= self.req_int
+        self.interval_end = interval_start + self.req_int
+        self.grid = (self.delta, self.req_int)
         time_per_probe = float(self.req_int) / len(self.ec2hosts)
-        self.probes = [Probe(ec2host, self.req_names, self.clock_offset, time_per_probe) 
-                        for ec2host in self.ec2hosts]
-        self.probe_timers = [threading.Timer(max(0, init_delay + time_per_probe * i), probe.do_probe)
-                        for i, probe in enumerate(self.probes)]
-        for probe_timer in self.probe_timers:
-            probe_timer.start()
-        self.reset_timer = threading.Timer(max(0, init_delay + self.req_int), self.__reset)
-        self.reset_timer.start()
+        time_per_request = time_per_probe / len(self.req_names)
+        self.probes = [Probe(ec2host, self.req_names, self.clock_offset, self.clock_error, self.tracer,
+                        time_per_probe) for ec2host in self.ec2hosts]
+        self.engine.resolve([(probe.host, probe.port) for probe in self.probes])
+        for i, probe in enumerate(self.probes):
+            for j, req_name in enumerate(self.req_names):
+                self.engine.schedule(HttpFetch(probe, req_name),
+                    clock + max(0, interval_start - now + time_per_probe * i + time_per_request * j))
+        self.scheduler.schedule(clock + self.interval_end - now, self.__reset)
         
     def __reset(self):
         if not self.running:
             return
+        self.drift = time.time() - self.clock_offset - self.interval_end
+        self.max_drift = max(self.max_drift, abs(self.drift))
         record = dict()
-        for probe_timer in self.probe_timers:
-            probe_timer.cancel()
         for probe in self.probes:
             record[probe.ec2host] = probe.end()
-        self.records.append(record)
-        threading.Thread(target=self.__do_exchange).start()
+        self.__add_record(record)
+        self.probe_times = self.__get_probe_times(record)
+        if self.uploads.empty(): # otherwise the upload waiting to run sends this record too
+            if session_mode:
+                self.uploads.put(self.__do_session)
+            else:
+                self.uploads.put(self.__do_exchange)
+        logging.debug('Interval ended: %s' % self.get_status())
         self.__setup()
 
+    def __get_probe_times(self, record):
+        """ average seconds the requests to each EC2 host took, -1 for hosts which did not answer """
+        probe_times = list()
+        for ec2host in self.ec2hosts:
+            durations = list()
+            for timing in record.get(ec2host, { 'times': {} })['times'].values():
+                duration = timing[2]
+                if len(timing) >= 9: # the warm request follows right after
+                    duration += timing[7] + timing[8]
+                durations.append(duration)
+            if len(durations) > 0:
+                probe_times.append(sum(durations) / len(durations))
+            else:
+                probe_times.append(-1.0)
+        return probe_times
+
+    def __upload(self, uploads):
+        """ runs the uploads queued by __reset one after the other, until None is queued """
+        while True:
+            upload = uploads.get()
+            if upload is None:
+                break
+            try:
+                upload()
+            except:
+                logging.info('ERROR: upload failed \n%s' % traceback.format_exc())
+
+    def get_status(self):
+        return 'drift %.3fs (max %.3fs), scheduler: %s, probes: %s' % (
+            self.drift, self.max_drift, self.scheduler.get_status(), self.engine.get_status())
+
     def register(self):
         while True:
             self.__do_hello()
@@ -302,35 +1434,188 @@ class Node():
         if self.running:
             logging.info('ERROR: client already running')
             return
+        for i in range(clock_sync_samples - 1): # registering took the first sample
+            self.__do_exchange()
         self.running = True
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.uploads = Queue.Queue()
+        uploader = threading.Thread(target=self.__upload, args=(self.uploads,))
+        uploader.setDaemon(True)
+        uploader.start()
+        self.engine = ProbeEngine()
+        self.engine.start()
+        self.tracer = PathTracer()
+        self.tracer.start()
         self.__setup()
         
     def stop(self):
         self.running = False
-        if self.reset_timer is not None:
-            self.reset_timer.cancel()
-            self.reset_timer = None
-        if self.probe_timers is not None:
-            for probe_timer in self.probe_timers:
-                probe_timer.cancel()
-            self.probe_timers = None
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
+        if self.uploads is not None:
+            self.uploads.put(None)
+            self.uploads = None
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine = None
+        if self.tracer is not None:
+            self.tracer.stop()
+            self.tracer = None
         if self.probes is not None:
             record = dict()
             for probe in self.probes:
                 record[probe.ec2host] = probe.end()
-            self.records.append(record)
+            self.__add_record(record)
             self.probes = None
-        self.last_probing = None
+        self.interval_end = None
         self.handler.close()
     
 #---------------------------------------------------------------------------------------------------------------------
 
+class RecordSpool():
+    """
+    append-only log of the records not yet committed by the server, so the backlog survives restarts
+    and is not held in memory; each entry is a u4 length and the record encoded by pack_records().
+    The 'state' file names the upload stream, the current log file, the sequence number and byte
+    offset of the first uncommitted record and the wire version the records are encoded in; it is
+    replaced atomically on every commit. Once committed records take 'spool_compact' bytes, the rest is
+    copied to a new log file which replaces the old one, as are records of an older wire version.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        state_file = os.path.join(dirname, 'state')
+        if os.path.isfile(state_file):
+            f = open(state_file, 'r')
+            fields = f.read().split()
+            f.close()
+            self.stream, self.log_name = fields[:2]
+            self.seq, self.offset = int(fields[2]), int(fields[3])
+            self.version = 2 # spools predating structured traces
+            if len(fields) > 4:
+                self.version = int(fields[4])
+        else:
+            self.stream = uuid.uuid4().hex # the server dedupes uploaded chunks by (stream, seq)
+            self.log_name = 'records-0.log'
+            self.seq = 0 # sequence number of the first uncommitted record
+            self.offset = 0 # its offset in the log file
+            self.version = wire_version
+        # count the uncommitted records, dropping one whose writing was interrupted
+        self.count = 0
+        log_file = os.path.join(dirname, self.log_name)
+        end = self.offset
+        if os.path.isfile(log_file):
+            f = open(log_file, 'r+b')
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(end)
+            while end + 4 <= size:
+                length = struct.unpack('!I', f.read(4))[0]
+                if end + 4 + length > size:
+                    break
+                f.seek(length, os.SEEK_CUR)
+                end += 4 + length
+                self.count += 1
+            if end < size:
+                f.truncate(end)
+            f.close()
+        self.log = open(log_file, 'ab')
+        if self.version != wire_version:
+            self.compact()
+        else:
+            self.save_state()
+
+    def __len__(self):
+        return self.count
+
+    def save_state(self):
+        tmp_file = os.path.join(self.dirname, 'state.tmp')
+        f = open(tmp_file, 'w')
+        f.write('%s %s %d %d %d\n' % (self.stream, self.log_name, self.seq, self.offset, self.version))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp_file, os.path.join(self.dirname, 'state'))
+
+    def append(self, record):
+        body = pack_records([record])
+        self.log.write(struct.pack('!I', len(body)) + body)
+        self.log.flush()
+        self.count += 1
+
+    def read(self, count):
+        """ chunk of the first 'count' uncommitted records """
+        records = list()
+        f = open(os.path.join(self.dirname, self.log_name), 'rb')
+        f.seek(self.offset)
+        for i in range(min(count, self.count)):
+            length = struct.unpack('!I', f.read(4))[0]
+            records.append(unpack_records(f.read(length), 0, self.version)[0][0])
+        f.close()
+        return { 'seq': self.seq, 'records': records }
+
+    def commit(self, seq):
+        """ marks the records before sequence number 'seq' as committed by the server """
+        count = min(seq - self.seq, self.count)
+        if count <= 0:
+            return
+        f = open(os.path.join(self.dirname, self.log_name), 'rb')
+        f.seek(self.offset)
+        for i in range(count):
+            length = struct.unpack('!I', f.read(4))[0]
+            f.seek(length, os.SEEK_CUR)
+        self.offset = f.tell()
+        f.close()
+        self.seq += count
+        self.count -= count
+        if self.offset >= spool_compact:
+            self.compact()
+        else:
+            self.save_state()
+
+    def compact(self):
+        """ moves the uncommitted records to a new log file, in the current wire version """
+        old_name = self.log_name
+        self.log_name = 'records-%d.log' % (int(old_name[8:-4]) + 1)
+        self.log.close()
+        src = open(os.path.join(self.dirname, old_name), 'rb')
+        src.seek(self.offset)
+        dst = open(os.path.join(self.dirname, self.log_name), 'wb')
+        if self.version == wire_version:
+            shutil.copyfileobj(src, dst)
+        else:
+            for i in range(self.count):
+                length = struct.unpack('!I', src.read(4))[0]
+                body = pack_records(unpack_records(src.read(length), 0, self.version)[0])
+                dst.write(struct.pack('!I', len(body)) + body)
+            self.version = wire_version
+        dst.flush()
+        os.fsync(dst.fileno())
+        dst.close()
+        src.close()
+        self.offset = 0
+        self.save_state()
+        os.remove(os.path.join(self.dirname, old_name))
+        self.log = open(os.path.join(self.dirname, self.log_name), 'ab')
+
+#---------------------------------------------------------------------------------------------------------------------
+
 class SocketHandler():
     def __init__(self, _server_ip, _server_port):
         self.server_ip = _server_ip
         self.server_port = _server_port
         self.connected = False
         self.str_address = '%s:%d' % (self.server_ip, self.server_port)
+        self.wire_flags = 0 # added to commands starting an exchange of objects
+        if wire_format == 'schema':
+            self.wire_flags = WIRE_SCHEMA
+        self.recv_buffer = None
+        if recv_into_supported:
+            self.recv_buffer = bytearray(recv_size) # reused for every read, see recv_object
         
     def connect(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -344,46 +1629,56 @@ class SocketHandler():
         """ force close client socket """
         try:
             self.connected = False
-            self.sock.shutdown()
+            self.sock.shutdown(socket.SHUT_RDWR)
             self.sock.close()
         except:
             pass
                     
-    def send_object(self, obj):
-        """ write an object to client socket as a pickle string """
+    def send_object(self, obj, schema):
+        """ write an object to client socket, encoded with 'schema' or as a pickle string """
         if not self.connected:
             return
         try:
-            pickle_str = zlib.compress(pickle.dumps(obj))
+            if self.wire_flags & WIRE_SCHEMA:
+                pickle_str = zlib.compress(encode_message(schema, obj))
+            else:
+                pickle_str = zlib.compress(pickle.dumps(obj))
             netw_str = struct.pack('!I%ds' % len(pickle_str), len(pickle_str), pickle_str)
             self.sock.sendall(netw_str)
         except:
             logging.debug('ERROR: socket write to %s failed \n%s' % (self.str_address, traceback.format_exc()))
             self.close()
             
-    def recv_object(self):
-        """ reads a pickled string from the client socket and decodes it into an object """
+    def recv_object(self, schema):
+        """ reads an object encoded with 'schema' or as a pickle string from the client socket """
         if not self.connected:
             return None
         len_size = struct.calcsize('!I')
-        bytes = self.sock.recv(len_size)
-        if len(bytes) != len_size:
-            logging.debug('ERROR: server %s closed socket before data size was read' % self.str_address)
-            self.close()
-            return None
-        len_val = struct.unpack('!I', bytes)[0]
-        len_struct = struct.calcsize('%ds' % len_val)
-        val_struct = ''
-        while len(val_struct) < len_struct:
-            bytes = self.sock.recv(4096)
-            if len(bytes) == 0:
-                logging.debug('ERROR: server %s closed socket before pickle data was read' % self.str_address)
+        bytes = ''
+        while len(bytes) < len_size:
+            chunk = self.sock.recv(len_size - len(bytes))
+            if len(chunk) == 0:
+                logging.debug('ERROR: server %s closed socket before data size was read' % self.str_address)
                 self.close()
                 return None
-            val_struct += bytes
+            bytes += chunk
         try:
-            pickle_str = struct.unpack('%ds' % len_val, val_struct)[0]
-            return pickle.loads(zlib.decompress(pickle_str))
+            # the frame body is decompressed as it arrives, so it is never held in memory as a whole
+            frame = FrameDecoder(struct.unpack('!I', bytes)[0], max_frame_size, max_object_size)
+            while frame.remaining > 0:
+                if self.recv_buffer is not None:
+                    count = self.sock.recv_into(self.recv_buffer, min(frame.remaining, recv_size))
+                    data = buffer(self.recv_buffer, 0, count)
+                else:
+                    data = self.sock.recv(min(frame.remaining, recv_size))
+                if len(data) == 0:
+                    logging.debug('ERROR: server %s closed socket before pickle data was read' % self.str_address)
+                    self.close()
+                    return None
+                frame.feed(data)
+            if self.wire_flags & WIRE_SCHEMA:
+                return decode_message(schema, frame.finish())
+            return pickle.loads(frame.finish())
         except:
             logging.debug('ERROR: server %s sent invalid pickle data \n%s' % (self.str_address, traceback.format_exc()))
             self.close()
@@ -402,7 +1697,14 @@ class SocketHandler():
         """ reads a 1-byte command from the client socket """
         if not self.connected:
             return None
-        command = self.sock.recv(1)
+        try:
+            command = self.sock.recv(1)
+        except socket.timeout:
+            logging.info('ERROR: no command from server %s before the socket timed out' % self.str_address)
+            self.close()
+            return None
+        except socket.error:
+            command = '' # socket closed by another thread, e.g. while reading a session
         if len(command) == 0:
             logging.debug('ERROR: server %s closed socket before command was read' % self.str_address)
             self.close()
@@ -10,7 +10,7 @@ import socket
 def enum(**enums):
     return type('Enum', (), enums)
 
-Commands = enum(REFRESH=0x1, SHUTDOWN=0x2, HELLO=0x4, PLANETLAB=0x8, OK=0x16, ERROR=0x32, STATUS=0x64)
+Commands = enum(REFRESH=0x1, SHUTDOWN=0x2, HELLO=0x4, PLANETLAB=0x8, SESSION=0x10, CLOCK=0x20, OK=0x16, ERROR=0x32, STATUS=0x64)
 
 #---------------------------------------------------------------------------------------------------------------------
 
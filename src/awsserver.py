@@ -8,14 +8,19 @@ import traceback
 import time
 import datetime
 import socket
+import asyncore
 import threading
-import SocketServer
+import heapq
+import math
+import collections
+import Queue
 import uuid
 import json
 import pickle
 import struct
 import logging
 import zlib
+from awswire import WIRE_SCHEMA, wire_version, encode_message, decode_message, FrameDecoder
 
 
 # Customizable params:
@@ -26,6 +31,27 @@ req_file = 'requests.txt' # filename containing names of files to request from E
 req_int = 15 * 60 # request interval in seconds for Planet-Lab nodes
 data_dir = 'data/' # folder where all measurement data is collected
 dead_int = 3600 # if a node has not been seen for an hour, it is considered dead
+nr_slots = 1024 # time slots allocated to nodes to even out request making times during each 'req_int' period
+max_host_concurrency = 4 # requests of different nodes the slots are chosen to keep in flight against an EC2 host at once
+default_probe_time = 2.0 # seconds a request is assumed to take until its node reports its probe times
+move_margin = 2 # requests in flight at once by which moving a node must lower its peak, so jitter doesn't move it
+move_hold = 4 # request intervals a moved node stays in its new slot before it may be moved again
+max_connections = 4096 # concurrent exchanges; further clients wait in the listen backlog
+listen_backlog = 1024 # pending connections queued by the kernel
+conn_timeout = 120 # seconds a connection may stay idle before it is dropped
+session_timeout = 3 * req_int # seconds a session (see Commands.SESSION) may stay idle before it is dropped
+recv_size = 65536 # bytes read from a client socket at once
+max_out_buffer = 1024 * 1024 # stop reading from a client while this many reply bytes are unsent
+max_frame_size = 64 * 1024 * 1024 # largest compressed object accepted from a client
+max_object_size = 256 * 1024 * 1024 # largest object accepted from a client once decompressed
+accept_pickle = True # accept pickled objects from nodes not using the schema wire format (unsafe with untrusted nodes)
+write_queue_size = 4096 # received payloads waiting to be written; when full, data is refused and the node retries
+write_batch = 256 # payloads written to disk before the data files are flushed
+max_open_files = 256 # data files kept open by the writer
+fsync_policy = 'interval' # 'always' (after every batch), 'interval' (every 'fsync_int' seconds) or 'never'
+fsync_int = 10 # seconds between fsync() calls for the 'interval' policy
+storage_backend = 'text' # 'text' (a JSON-lines file per node) or 'segments' (binary segment log, see SegmentStorage)
+segment_size = 64 * 1024 * 1024 # bytes after which a segment is sealed and a new one started
 
 #---------------------------------------------------------------------------------------------------------------------
 
@@ -33,7 +59,8 @@ dead_int = 3600 # if a node has not been seen for an hour, it is considered dead
 
 ec2hosts = None # list of EC2 hostnames or IPs (port is always 80)
 req_names = None # list of file names to be requested from EC2 instances
-slots = [None] * 1024 # time slots allocated to nodes to even out request making times during each 'req_int' period
+registry = None # NodeRegistry of the known PlanetLab nodes, init in __main__
+writer = None # DataWriter storing received measurements, init in __main__
 
 #---------------------------------------------------------------------------------------------------------------------
 
@@ -52,7 +79,7 @@ logging.getLogger('').addHandler(console)
 def enum(**enums):
     return type('Enum', (), enums)
 
-Commands = enum(REFRESH=0x1, SHUTDOWN=0x2, HELLO=0x4, PLANETLAB=0x8, OK=0x16, ERROR=0x32, STATUS=0x64)
+Commands = enum(REFRESH=0x1, SHUTDOWN=0x2, HELLO=0x4, PLANETLAB=0x8, SESSION=0x10, CLOCK=0x20, OK=0x16, ERROR=0x32, STATUS=0x64)
 
 def ensure_path(path):
     """ creates directory tree if it does not exist """
@@ -92,47 +119,277 @@ def refresh_config():
     id = unique identifier
     address = remote ip address
     last_seen = timestamp when last connected
-    slot = index in slots[]
+    slot = index in NodeRegistry.slots[]
     delta = assigned wait time before making requests (= slot2time(slot))
     hostname = socket.gethostname() on PlanetLab node
+    stream = upload stream of the node; records it uploads are numbered within the stream
+    committed = sequence number of the next record expected from 'stream'
+    probe_times = average seconds the requests of the node to each EC2 host took in its last interval
+                  (-1 for hosts which did not answer), None until it reports them
+    footprint = {(ec2host index, slot): requests} the node has in flight at that time, see get_footprint()
+    moved = timestamp when NodeRegistry.update() last moved the node to another slot, None if never
 """
 
-def filter_dead():
-    """ remove nodes from 'slots[]' which haven't connected to the server in a long time """
-    global slots
-    logging.debug('Filtering dead nodes..')
-    now = time.time()
-    slots = [node if (node is not None) and (now - node['last_seen'] < dead_int) else None
-                for node in slots]
-
-def find_node(id):
-    for node in slots:
-        if node is not None:
-            if node['id'] == id:
-                return node
-    return None
-
-def get_new_slot():
-    step = len(slots)
+def get_spread_order(size):
+    """
+    order in which slots are handed out: the middle slot first, then the middles of the two halves,
+    and so on, so that nodes are spread as evenly as possible over 'req_int' at all times
+    """
+    order = list()
+    seen = set()
+    step = float(size)
     while True:
         curr = 0
         while True:
             i = int(curr + step / 2.0)
-            if i >= len(slots):
+            if i >= size:
                 break
-            if slots[i] is None:
-                return i
+            if i not in seen:
+                seen.add(i)
+                order.append(i)
             curr += step
         if step <= 1:
-            return None
-        step /= 2.0 
+            break
+        step /= 2.0
+    return order + [i for i in range(size) if i not in seen]
+
+class NodeRegistry():
+    """
+    known nodes, indexed by id and by slot; free slots wait in a heap ordered by get_spread_order()
+    and nodes in a heap ordered by 'last_seen', so lookup and expiry never scan all slots (both heaps
+    are lazy: entries made stale by later changes are skipped when popped). The footprints of the
+    nodes add up to the number of requests in flight against every EC2 host in every slot: a node
+    gets the first free slot in spread order which keeps them at most 'max_host_concurrency', or the
+    one keeping their peak lowest if none does, and is moved when the probe times it reports make its
+    slot exceed the ceiling (at most once every 'move_hold' intervals, and only if that lowers its peak
+    by 'move_margin'); free slots are only scanned past the first while the ceiling is reached
+    """
+
+    def __init__(self, size):
+        self.lock = threading.RLock()
+        self.slots = [None] * size
+        self.nodes = dict()
+        self.rank = [0] * size
+        for rank, slot in enumerate(get_spread_order(size)):
+            self.rank[slot] = rank
+        self.free = [(self.rank[slot], slot) for slot in range(size)]
+        heapq.heapify(self.free)
+        self.expiry = list()
+        self.load = collections.defaultdict(lambda: [0] * size) # ec2host index -> requests in flight per slot
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get_nodes(self):
+        """ known nodes ordered by slot """
+        with self.lock:
+            return sorted(self.nodes.values(), key=lambda node: node['slot'])
+
+    def find(self, id):
+        with self.lock:
+            return self.nodes.get(id)
+
+    def get_peak(self, footprint):
+        """ most requests in flight against an EC2 host at once if 'footprint' is added """
+        peak = 0
+        for (host, bin), count in footprint.items():
+            peak = max(peak, self.load[host][bin] + count)
+        return peak
+
+    def get_peaks(self, probe_times):
+        """ get_peak() of the footprint of a node with 'probe_times' in each slot, from window maxima of the load """
+        footprint = get_footprint(0, probe_times)
+        peaks = [0] * len(self.slots)
+        runs = list() # [host, first slot, slots, requests] of consecutive slots with the same requests in flight
+        for (host, bin), count in sorted(footprint.items()):
+            if len(runs) > 0 and runs[-1][0] == host and runs[-1][1] + runs[-1][2] == bin and runs[-1][3] == count:
+                runs[-1][2] += 1
+            else:
+                runs.append([host, bin, 1, count])
+        for host, first, width, count in runs:
+            maxima = window_max(self.load[host], width)
+            maxima = maxima[first:] + maxima[:first]
+            peaks = list(map(max, peaks, [value + count for value in maxima]))
+        return peaks
+
+    def place(self, node, slot):
+        node['slot'] = slot
+        node['delta'] = slot2time(slot)
+        node['footprint'] = get_footprint(slot, node['probe_times'])
+        self.slots[slot] = node
+        for (host, bin), count in node['footprint'].items():
+            self.load[host][bin] += count
+
+    def unplace(self, node):
+        self.slots[node['slot']] = None
+        self.unload(node)
+        heapq.heappush(self.free, (self.rank[node['slot']], node['slot']))
+
+    def unload(self, node):
+        for (host, bin), count in node['footprint'].items():
+            self.load[host][bin] -= count
+
+    def find_slot(self, probe_times):
+        """ (peak, slot) of the free slot chosen for a node with 'probe_times', (None, None) if all are taken """
+        best = (None, None)
+        peaks = None # of all slots, computed once the first free slot is over the ceiling
+        popped = list()
+        while len(self.free) > 0:
+            rank, slot = heapq.heappop(self.free)
+            if self.slots[slot] is not None or (len(popped) > 0 and popped[-1][1] == slot):
+                continue # stale or duplicate entry
+            popped.append((rank, slot))
+            if peaks is None:
+                peak = self.get_peak(get_footprint(slot, probe_times))
+                if peak > max_host_concurrency:
+                    peaks = self.get_peaks(probe_times)
+            else:
+                peak = peaks[slot]
+            if best[0] is None or peak < best[0]:
+                best = (peak, slot)
+            if peak <= max_host_concurrency:
+                break
+        for entry in popped:
+            heapq.heappush(self.free, entry)
+        return best
+
+    def add(self, hostname, address, id=None, slot=None, probe_times=None):
+        """ registers a node in 'slot' if it is free and within the ceiling, else as chosen above; None if all are taken """
+        with self.lock:
+            if slot is None or not (0 <= slot < len(self.slots)) or self.slots[slot] is not None or \
+                    self.get_peak(get_footprint(slot, probe_times)) > max_host_concurrency:
+                peak, slot = self.find_slot(probe_times)
+                if slot is None:
+                    return None
+            node = {
+                'id': id or str(uuid.uuid4()),
+                'address': address,
+                'last_seen': time.time(),
+                'hostname': hostname,
+                'stream': None,
+                'committed': None,
+                'probe_times': probe_times,
+                'moved': None
+            }
+            self.place(node, slot)
+            self.nodes[node['id']] = node
+            heapq.heappush(self.expiry, (node['last_seen'], node['id']))
+            return node
+
+    def update(self, node, probe_times):
+        """ records the probe times reported by a node, moving it if its slot exceeds the ceiling; True if moved """
+        with self.lock:
+            if self.nodes.get(node['id']) is not node or probe_times == node['probe_times']:
+                return False
+            slot = node['slot']
+            self.unload(node)
+            node['probe_times'] = probe_times
+            now = time.time()
+            held = node['moved'] is not None and now - node['moved'] < move_hold * req_int
+            peak = self.get_peak(get_footprint(slot, probe_times))
+            if peak > max_host_concurrency and not held:
+                best_peak, best_slot = self.find_slot(probe_times)
+                if best_slot is not None and best_peak <= peak - move_margin:
+                    logging.debug('Moving %s from slot %d to %d (%d instead of %d requests in flight at once)' % (
+                        node['hostname'], slot, best_slot, best_peak, peak))
+                    self.slots[slot] = None
+                    heapq.heappush(self.free, (self.rank[slot], slot))
+                    self.place(node, best_slot)
+                    node['moved'] = now
+                    return True
+            self.place(node, slot)
+            return False
+
+    def rebuild(self):
+        """ recomputes all footprints, after the EC2 hosts or request names changed """
+        with self.lock:
+            self.load.clear()
+            for node in self.nodes.values():
+                self.place(node, node['slot'])
+
+    def get_status(self):
+        with self.lock:
+            return 'at most %d requests in flight against an EC2 host at once (ceiling %d)' % (
+                max([0] + [max(load) for load in self.load.values()]), max_host_concurrency)
+
+    def touch(self, node):
+        with self.lock:
+            node['last_seen'] = time.time()
+            heapq.heappush(self.expiry, (node['last_seen'], node['id']))
+
+    def remove(self, node):
+        with self.lock:
+            if self.nodes.get(node['id']) is node:
+                del self.nodes[node['id']]
+                self.unplace(node)
+
+    def expire(self):
+        """ remove nodes which haven't connected to the server in a long time """
+        logging.debug('Filtering dead nodes..')
+        now = time.time()
+        with self.lock:
+            while len(self.expiry) > 0 and now - self.expiry[0][0] >= dead_int:
+                last_seen, id = heapq.heappop(self.expiry)
+                node = self.nodes.get(id)
+                if node is not None and node['last_seen'] == last_seen:
+                    self.remove(node)
 
 def slot2time(slot):
-    return slot * req_int / float(len(slots))
+    return slot * req_int / float(nr_slots)
     
 def time2slot(time):
-    return time * len(slots) / float(req_int)
+    return time * nr_slots / float(req_int)
+
+def window_max(values, width):
+    """ maxima of the 'width' values starting at each index of 'values', wrapping around at the end """
+    maxima, span = values, 1
+    width = min(width, len(values))
+    while span * 2 <= width:
+        maxima = list(map(max, maxima, maxima[span:] + maxima[:span]))
+        span *= 2
+    if span < width: # the windows of 'span' at both ends of each window of 'width' cover it
+        maxima = list(map(max, maxima, maxima[width - span:] + maxima[:width - span]))
+    return maxima
+
+def get_footprint(slot, probe_times):
+    """
+    {(ec2host index, slot): requests} in flight at that time for a node in 'slot', which requests the
+    EC2 hosts at the times Node.__setup() of the client spaces them out at, each for its probe time
+    """
+    footprint = dict()
+    if not ec2hosts or not req_names:
+        return footprint
+    time_per_probe = float(req_int) / len(ec2hosts)
+    time_per_request = time_per_probe / len(req_names)
+    for i in range(len(ec2hosts)):
+        probe_time = default_probe_time
+        if probe_times is not None and len(probe_times) == len(ec2hosts) and probe_times[i] >= 0:
+            probe_time = probe_times[i]
+        for j in range(len(req_names)):
+            start = slot + time2slot(time_per_probe * i + time_per_request * j)
+            end = max(int(start) + 1, int(math.ceil(start + time2slot(probe_time))))
+            for bin in range(int(start), end):
+                key = (i, bin % nr_slots)
+                footprint[key] = footprint.get(key, 0) + 1
+    return footprint
     
+def get_node_info(node, stream=None, recv_time=None):
+    """
+    reply telling a node its slot, the current configuration and how much of 'stream' is committed;
+    'recv_time' is when the greeting it answers was received, for the node to estimate its clock offset
+    """
+    return {
+        'id': node['id'],
+        'slot': node['slot'],
+        'delta': node['delta'],
+        'req_int': req_int,
+        'now': time.time(),
+        'ec2hosts': ec2hosts,
+        'req_names': req_names,
+        'committed': node['committed'] if stream is not None and node['stream'] == stream else None,
+        'recv': recv_time
+    }
+
 def time2str(time):
     return '%02dm%02ds.%d' % (
         int(time) / 60,
@@ -142,119 +399,571 @@ def time2str(time):
     
 #---------------------------------------------------------------------------------------------------------------------
 
-def store_data(node, data):
-    try:
-        logging.debug('New data (%d records) from s%d' % (len(data['records']), node['slot']))
+class TextStorage():
+    """
+    one text file per node: a header with the node id, hostname and address, then a JSON record per line;
+    recently used files are kept open in an LRU pool of at most 'max_open_files' handles
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.files = collections.OrderedDict() # filename -> open file, least recently used first
+
+    def get_file(self, node):
         shortname = node['hostname']
         if shortname is None or len(shortname) < 1:
             shortname = node['id']
-        filename = os.path.join(data_dir, shortname + '.txt')
-        mode = 'a' if os.path.isfile(filename) else 'w'
-        with open(filename, mode) as f:
-            if mode == 'w':
+        filename = os.path.join(self.dirname, shortname + '.txt')
+        f = self.files.pop(filename, None)
+        if f is None:
+            while len(self.files) >= max_open_files:
+                self.files.popitem(last=False)[1].close()
+            f = open(filename, 'a')
+            if f.tell() == 0:
                 f.write('%s\n%s\n%s\n' % (node['id'], node['hostname'], node['address']))
-            for record in data['records']:
-                f.write(json.dumps(record) + '\n')
-    except:
-        logging.info('ERROR: failed writing to data file \'%s\' \n%s' % (filename, traceback.format_exc()))
+        self.files[filename] = f
+        return f
 
-#---------------------------------------------------------------------------------------------------------------------
+    def write(self, node, data):
+        f = self.get_file(node)
+        for record in data['records']:
+            f.write(json.dumps(record) + '\n')
 
-class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
-    pass
+    def flush(self, sync=False):
+        for f in self.files.values():
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
 
-class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler): # could use SocketServer.StreamRequestHandler
-    start_time = time.time() # time when server started
+    def close(self):
+        while len(self.files) > 0:
+            self.files.popitem()[1].close()
 
-    def assign_slot(self, hostname):
-        """ assigns a new node and assigns it in a position in 'slots[]' """
-        slot = get_new_slot()
-        if slot is None:
-            logging.info('ERROR: No time slot available for %s', self.str_address)
-            self.send_command(Commands.ERROR)
-            self.close_client_socket()
-            return None
-        else:
-            slots[slot] = {
-                'id': str(uuid.uuid4()),
-                'address': self.str_address,
-                'last_seen': time.time(),
-                'slot': slot,
-                'delta': slot2time(slot),
-                'hostname': hostname
-            }
-            return slots[slot]
-            
-    def close_client_socket(self):
-        """ force close client socket """
+
+"""
+'segments' storage layout, all numbers little-endian:
+    seg-NNNNNN.bin  = header, fixed-width timing records and, once the segment is sealed, an index footer
+        header      = magic 'AWSG', u2 version, u2 record size
+        record      = u4 node id, u2 ec2host id, u2 request id, f8 start time, f4 connect time, f4 GET time,
+                      and since version 2 f4 dns, connect, first_byte, body, warm_first_byte and warm_body
+                      phases (NaN if not measured), see the record format of the client
+        footer      = u8 record count, f8 first start time, f8 last start time, magic 'AWSX'
+    names.jsonl     = [kind, id, name] per line for the 'node', 'ec2host' and 'request' ids used in records
+    traces.jsonl    = [node id, ec2host id, time, hops] per line, see the record format of the client;
+                      older clients send the tracepath output instead of hops
+    clocks.jsonl    = [node id, time, clock offset, clock error] per record, time being its first start
+                      time: the offset of the node's clock it was measured with, already subtracted
+Segments are sealed when they reach 'segment_size' bytes and at shutdown; an unsealed segment, left
+by a crash, holds records up to its last complete one and is sealed when the server starts again.
+Readers take the record size of a segment from its header, so segments of both versions can be mixed.
+"""
+
+segment_magic = 'AWSG'
+segment_version = 2
+segment_header = struct.Struct('<4sHH')
+segment_record = struct.Struct('<IHHdff6f')
+segment_phases = 6 # timing values after start, connect and GET times stored in a record
+segment_footer = struct.Struct('<Qdd4s')
+segment_footer_magic = 'AWSX'
+
+
+class SegmentStorage():
+    """ appends records of all nodes to rotating binary segment files, see the layout above """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.ids = dict((kind, dict()) for kind in ['node', 'ec2host', 'request'])
+        names_filename = os.path.join(dirname, 'names.jsonl')
+        if os.path.isfile(names_filename):
+            with open(names_filename, 'r') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        kind, id, name = json.loads(line)
+                        self.ids[kind][name] = id
+        self.names = open(names_filename, 'a')
+        self.traces = open(os.path.join(dirname, 'traces.jsonl'), 'a')
+        self.clocks = open(os.path.join(dirname, 'clocks.jsonl'), 'a')
+        self.segment = None
+        self.seg_nr = 0
+        for filename in sorted(os.listdir(dirname)):
+            if filename.startswith('seg-') and filename.endswith('.bin'):
+                self.seg_nr = int(filename[4:-4])
+                self.seal_file(os.path.join(dirname, filename))
+
+    def get_id(self, kind, name):
+        """ interned id of a name, logged to the names file when first seen """
+        ids = self.ids[kind]
+        id = ids.get(name)
+        if id is None:
+            id = len(ids)
+            ids[name] = id
+            self.names.write(json.dumps([kind, id, name]) + '\n')
+            self.names.flush() # before any record using the id can reach the disk
+        return id
+
+    def open_segment(self):
+        self.seg_nr += 1
+        self.segment = open(os.path.join(self.dirname, 'seg-%06d.bin' % self.seg_nr), 'wb')
+        self.segment.write(segment_header.pack(segment_magic, segment_version, segment_record.size))
+        self.seg_count = 0
+        self.seg_first = None
+        self.seg_last = None
+
+    def seal_segment(self):
+        self.segment.write(segment_footer.pack(self.seg_count, self.seg_first or 0.0, self.seg_last or 0.0,
+            segment_footer_magic))
+        self.segment.close()
+        self.segment = None
+
+    def seal_file(self, filename):
+        """ adds the footer to a segment left unsealed, dropping a partially written last record """
+        with open(filename, 'r+b') as f:
+            header = f.read(segment_header.size)
+            record_size = segment_record.size
+            if len(header) == segment_header.size: # segments of older versions have smaller records
+                record_size = segment_header.unpack(header)[2]
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size >= segment_header.size + segment_footer.size:
+                f.seek(size - segment_footer.size)
+                count, first, last, magic = segment_footer.unpack(f.read(segment_footer.size))
+                if magic == segment_footer_magic and \
+                        segment_header.size + count * record_size + segment_footer.size == size:
+                    return
+            logging.info('Sealing segment %s left open..' % filename)
+            count = max(0, size - segment_header.size) // record_size
+            first = last = None
+            f.seek(segment_header.size)
+            for i in range(count):
+                start = struct.unpack_from('<d', f.read(record_size), 8)[0]
+                first = start if first is None else min(first, start)
+                last = start if last is None else max(last, start)
+            f.seek(segment_header.size + count * record_size)
+            f.truncate()
+            f.write(segment_footer.pack(count, first or 0.0, last or 0.0, segment_footer_magic))
+
+    def write(self, node, data):
+        shortname = node['hostname']
+        if shortname is None or len(shortname) < 1:
+            shortname = node['id']
+        node_id = self.get_id('node', shortname)
+        if self.segment is None:
+            self.open_segment()
+        packed = list()
+        for record in data['records']:
+            first = clock = None
+            for ec2host, record_data in record.items():
+                ec2host_id = self.get_id('ec2host', ec2host)
+                clock = record_data.get('clock') or clock
+                for request, timing in record_data['times'].items():
+                    phases = list(timing[3:3 + segment_phases])
+                    phases.extend([float('nan')] * (segment_phases - len(phases)))
+                    packed.append(segment_record.pack(node_id, ec2host_id, self.get_id('request', request),
+                        timing[0], timing[1], timing[2], *phases))
+                    self.seg_first = timing[0] if self.seg_first is None else min(self.seg_first, timing[0])
+                    self.seg_last = timing[0] if self.seg_last is None else max(self.seg_last, timing[0])
+                    first = timing[0] if first is None else min(first, timing[0])
+                trace = record_data.get('trace')
+                if trace is not None and trace[1]:
+                    self.traces.write(json.dumps([node_id, ec2host_id, trace[0], trace[1]]) + '\n')
+            if clock is not None and first is not None:
+                self.clocks.write(json.dumps([node_id, first, clock[0], clock[1]]) + '\n')
+        self.segment.write(''.join(packed))
+        self.seg_count += len(packed)
+        if self.segment.tell() >= segment_size:
+            self.seal_segment()
+
+    def flush(self, sync=False):
+        for f in [self.names, self.traces, self.clocks, self.segment]:
+            if f is not None:
+                f.flush()
+                if sync:
+                    os.fsync(f.fileno())
+
+    def close(self):
+        if self.segment is not None:
+            self.seal_segment()
+        self.names.close()
+        self.traces.close()
+        self.clocks.close()
+
+
+class DataWriter(threading.Thread):
+    """
+    background thread storing the data received by the event loop; payloads wait in a queue bounded
+    by 'write_queue_size', are written in batches of up to 'write_batch' and then flushed to disk,
+    with fsync() calls made according to 'fsync_policy'
+    """
+
+    def __init__(self, storage):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.storage = storage
+        self.queue = Queue.Queue(write_queue_size)
+        self.last_sync = time.time()
+        self.records = 0 # records written so far
+        self.batches = 0 # batches written so far
+        self.lag = 0.0 # seconds the last written payload spent in the queue
+        self.max_lag = 0.0
+
+    def submit(self, node, data):
+        """ queues data received from a node; False if the queue is full and the data was not accepted """
         try:
-            self.request.shutdown()
-            self.request.close()
-        except:
-            pass
-                    
-    def send_object(self, obj):
-        """ write an object to client socket as pickle string """
+            self.queue.put_nowait((time.time(), dict(node), data))
+        except Queue.Full:
+            logging.info('ERROR: write queue full, refusing data from %s' % node['hostname'])
+            return False
+        return True
+
+    def stop(self):
+        """ writes out everything queued so far and closes all data files """
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except Queue.Empty:
+                batch = []
+            while 0 < len(batch) < write_batch and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if len(batch) > 0 and batch[-1] is None:
+                running = False
+                batch.pop()
+            for queued, node, data in batch:
+                try:
+                    logging.debug('New data (%d records) from s%d' % (len(data['records']), node['slot']))
+                    self.storage.write(node, data)
+                    self.records += len(data['records'])
+                except:
+                    logging.info('ERROR: failed writing data from %s \n%s' % (node['hostname'], traceback.format_exc()))
+                self.lag = time.time() - queued
+                self.max_lag = max(self.max_lag, self.lag)
+            if len(batch) > 0:
+                self.batches += 1
+            now = time.time()
+            sync = fsync_policy == 'always' and len(batch) > 0 or \
+                fsync_policy == 'interval' and now - self.last_sync >= fsync_int
+            try:
+                if len(batch) > 0 or sync:
+                    self.storage.flush(sync)
+            except:
+                logging.info('ERROR: failed flushing data files \n%s' % traceback.format_exc())
+            if sync:
+                self.last_sync = now
         try:
-            pickle_str = zlib.compress(pickle.dumps(obj))
-            netw_str = struct.pack('!I%ds' % len(pickle_str), len(pickle_str), pickle_str)
-            self.request.sendall(netw_str)
+            self.storage.flush(fsync_policy != 'never')
+            self.storage.close()
         except:
-            logging.debug('ERROR: socket write to %s failed \n%s' % (self.str_address, traceback.format_exc()))
-            self.close_client_socket()
-            
-    def recv_object(self):
-        """ reads a pickle string from the client socket and decodes it into an object """
-        len_size = struct.calcsize('!I')
-        bytes = self.request.recv(len_size)
-        if len(bytes) != len_size:
-            logging.debug('ERROR: client %s closed socket before data size was read' % self.str_address)
+            logging.info('ERROR: failed closing data files \n%s' % traceback.format_exc())
+
+    def get_status(self):
+        return 'queued %d/%d, lag %.3fs (max %.3fs), %d records in %d batches written' % (
+            self.queue.qsize(), write_queue_size, self.lag, self.max_lag, self.records, self.batches)
+
+#---------------------------------------------------------------------------------------------------------------------
+
+"""
+The server is a single asyncore event loop. Each connection is an ExchangeHandler whose exchange
+logic is the handle() generator: it yields RECV_COMMAND or RECV_OBJECT whenever it needs input from
+the client and is resumed with the decoded value once enough bytes have arrived, while everything
+it sends is buffered and written out as the socket becomes writable. Objects are waited for
+as (RECV_OBJECT, schema), naming the wire schema of the expected object.
+"""
+
+RECV_COMMAND = 'command'
+RECV_OBJECT = 'object'
+INCOMPLETE = object() # input buffered so far does not hold a complete command / object
+
+
+class ExchangeServer(asyncore.dispatcher):
+    """ listening socket; accepts at most 'max_connections' concurrent exchanges """
+
+    def __init__(self, address):
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(listen_backlog)
+        self.server_address = self.socket.getsockname()
+        self.handlers = set()
+        self.init_shutdown = False
+
+    def readable(self):
+        # once at the limit, new connections wait in the listen backlog
+        return len(self.handlers) < max_connections
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, address = pair
+            self.handlers.add(ExchangeHandler(sock, address, self))
+
+    def check_timeouts(self):
+        """ drops connections which have been idle for longer than their timeout """
+        now = time.time()
+        for handler in list(self.handlers):
+            if now - handler.last_activity > handler.timeout:
+                logging.debug('ERROR: client %s timed out' % handler.str_address)
+                handler.close()
+
+    def push_node_info(self):
+        """ sends every node with an open session its node info, e.g. after the configuration changed """
+        for handler in list(self.handlers):
+            if handler.session is not None:
+                handler.send_command(Commands.REFRESH)
+                handler.send_object(get_node_info(handler.session, handler.stream), 'node_info')
+
+    def drain(self, timeout=5):
+        """ keeps the loop running until all queued replies are written or 'timeout' expires """
+        deadline = time.time() + timeout
+        while time.time() < deadline and any(len(handler.out_buffer) > 0 for handler in self.handlers):
+            asyncore.loop(timeout=0.1, use_poll=True, count=1)
+
+    def handle_error(self):
+        logging.info('ERROR: server socket error \n%s' % traceback.format_exc())
+
+
+class ExchangeHandler(asyncore.dispatcher):
+    start_time = time.time() # time when server started
+
+    def __init__(self, sock, client_address, server):
+        asyncore.dispatcher.__init__(self, sock)
+        self.client_address = client_address
+        self.server = server
+        self.str_address = '%s:%d' % (self.client_address[0], self.client_address[1]) # pretty print client address
+        self.in_buffer = bytearray() # received bytes not parsed yet from 'in_offset' on, see take_input
+        self.in_offset = 0
+        self.out_buffer = ''
+        self.recv_buffer = bytearray(recv_size) # every read lands here first, see handle_read
+        self.frame = None # FrameDecoder of the object being received
+        self.wire_schema = False # objects are exchanged in the schema wire format, else pickled
+        self.wire_version = wire_version # schema wire format version used by the client
+        self.stream = None # upload stream named in the greeting
+        self.closing = False
+        self.last_activity = time.time()
+        self.timeout = conn_timeout
+        self.session = None # node whose session this connection is
+        self.exchange = self.handle()
+        self.waiting = None
+        self.resume(None)
+
+    def resume(self, value):
+        """ runs the exchange until it waits for input again """
+        try:
+            self.waiting = self.exchange.send(value)
+        except StopIteration:
+            self.waiting = None
             self.close_client_socket()
-            return None
-        len_val = struct.unpack('!I', bytes)[0]
-        len_struct = struct.calcsize('%ds' % len_val)
-        val_struct = ''
-        while len(val_struct) < len_struct:
-            bytes = self.request.recv(4096)
-            if len(bytes) == 0:
-                logging.debug('ERROR: client %s closed socket before pickle data was read' % self.str_address)
+
+    def readable(self):
+        # stop reading while the client is not draining our replies
+        return not self.closing and self.waiting is not None and len(self.out_buffer) < max_out_buffer
+
+    def writable(self):
+        return len(self.out_buffer) > 0
+
+    def recv_into(self, size):
+        """ reads up to 'size' bytes into 'recv_buffer'; like dispatcher.recv() for disconnects """
+        try:
+            count = self.socket.recv_into(self.recv_buffer, size)
+        except socket.error as why:
+            if why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+        if count == 0:
+            self.handle_close()
+        return count
+
+    def handle_read(self):
+        if self.frame is not None and self.input_size() == 0:
+            # frame bodies go straight from the receive buffer into the decompressor
+            count = self.recv_into(min(self.frame.remaining, recv_size))
+            if count == 0:
+                return
+            if not self.feed_frame(buffer(self.recv_buffer, 0, count)):
+                return
+        else:
+            count = self.recv_into(recv_size)
+            if count == 0:
+                return
+            self.in_buffer += self.recv_buffer[:count]
+        self.last_activity = time.time()
+        while self.waiting is not None and not self.closing:
+            value = self.parse_input(self.waiting)
+            if value is INCOMPLETE:
+                break
+            self.resume(value)
+
+    def handle_write(self):
+        sent = self.send(self.out_buffer)
+        self.out_buffer = self.out_buffer[sent:]
+        self.last_activity = time.time()
+        if self.closing and len(self.out_buffer) == 0:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        logging.debug('ERROR: connection with %s failed \n%s' % (self.str_address, traceback.format_exc()))
+        self.close()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.server.handlers.discard(self)
+        self.waiting = None
+
+    def input_size(self):
+        return len(self.in_buffer) - self.in_offset
+
+    def take_input(self, size):
+        """
+        consumes up to 'size' bytes of the input buffer; the parsed part is only dropped once it is at
+        least half of the buffer, so that each byte is moved a bounded number of times
+        """
+        data = str(self.in_buffer[self.in_offset:self.in_offset + size])
+        self.in_offset += len(data)
+        if self.in_offset * 2 >= len(self.in_buffer):
+            del self.in_buffer[:self.in_offset]
+            self.in_offset = 0
+        return data
+
+    def parse_input(self, waiting):
+        """ decodes the command or object the exchange waits for from the input buffer """
+        if waiting == RECV_COMMAND:
+            if self.input_size() < 1:
+                return INCOMPLETE
+            return ord(self.take_input(1))
+        if self.frame is None:
+            len_size = struct.calcsize('!I')
+            if self.input_size() < len_size:
+                return INCOMPLETE
+            len_val = struct.unpack('!I', self.take_input(len_size))[0]
+            try:
+                self.frame = FrameDecoder(len_val, max_frame_size, max_object_size)
+            except:
+                logging.debug('ERROR: client %s sent invalid pickle data \n%s' % (self.str_address, traceback.format_exc()))
                 self.close_client_socket()
                 return None
-            val_struct += bytes
+        if self.input_size() > 0: # frame bytes received together with the frame size
+            if not self.feed_frame(self.take_input(self.frame.remaining)):
+                return None
+        if self.frame.remaining > 0:
+            return INCOMPLETE
+        frame, self.frame = self.frame, None
         try:
-            pickle_str = struct.unpack('%ds' % len_val, val_struct)[0]
-            return pickle.loads(zlib.decompress(pickle_str))
+            if self.wire_schema:
+                body = frame.finish()
+                self.wire_version = ord(body[0])
+                return decode_message(waiting[1], body)
+            return pickle.loads(frame.finish())
         except:
             logging.debug('ERROR: client %s sent invalid pickle data \n%s' % (self.str_address, traceback.format_exc()))
             self.close_client_socket()
         return None
-         
-    def send_command(self, command):
-        """ sends a 1-byte command to the client socket """
-        sent = self.request.send(chr(command))
-        if sent != 1:
-            logging.debug('ERROR: socket send command to %s failed' % self.str_address)
+
+    def feed_frame(self, data):
+        """ passes received frame bytes to the decoder; False if the frame turned out invalid """
+        try:
+            self.frame.feed(data)
+            return True
+        except:
+            logging.debug('ERROR: client %s sent invalid pickle data \n%s' % (self.str_address, traceback.format_exc()))
+            self.frame = None
             self.close_client_socket()
+        return False
 
-    def recv_command(self):
-        """ reads a 1-byte command from the client socket """
-        command = self.request.recv(1)
-        if len(command) == 0:
-            logging.debug('ERROR: client %s closed socket before command was read' % self.str_address)
+    def assign_slot(self, hostname, id=None, slot=None, probe_times=None):
+        """ registers a node, in 'slot' if it is free, and assigns it a position in the registry """
+        node = registry.add(hostname, self.str_address, id, slot, probe_times)
+        if node is None:
+            logging.info('ERROR: No time slot available for %s', self.str_address)
+            self.send_command(Commands.ERROR)
             self.close_client_socket()
-            return None
-        return ord(command[0])
+        return node
 
+    def restore_node(self, greeting):
+        """ finds the node of a greeting, adding it back to the registry if the server does not know it """
+        node = registry.find(greeting['id'])
+        if node is None: # if server does not know about node add it to the registry,
+                         # restoring it to the same slot if that is still free
+            return self.assign_slot(greeting['hostname'], greeting['id'], greeting['slot'], greeting.get('probe_times'))
+        # server knows about node; update last seen time and, if reported, its probe times
+        registry.touch(node)
+        if greeting.get('probe_times') is not None:
+            registry.update(node, greeting['probe_times'])
+        return node
+
+    def commit_chunk(self, node, data):
+        """
+        queues the records of an uploaded chunk which the server did not commit before, so chunks
+        retransmitted after a lost acknowledgement are not stored twice; False if the writer refused them
+        """
+        seq = data.get('seq')
+        if seq is None or self.stream is None: # node sends its whole backlog at once
+            return writer.submit(node, data)
+        if node['stream'] != self.stream:
+            node['stream'] = self.stream
+            node['committed'] = seq
+        skip = node['committed'] - seq
+        if skip >= len(data['records']):
+            logging.debug('Chunk %d of %s was already committed' % (seq, node['hostname']))
+            return True
+        if skip < 0:
+            logging.info('ERROR: records %d..%d of %s are missing' % (node['committed'], seq - 1, node['hostname']))
+        elif skip > 0:
+            data = dict(data, records=data['records'][skip:])
+        if not writer.submit(node, data):
+            return False
+        node['committed'] = seq + len(data['records']) + max(0, skip)
+        return True
+
+    def close_client_socket(self):
+        """ closes the client socket once everything sent so far has been written """
+        self.closing = True
+        if len(self.out_buffer) == 0:
+            self.close()
+
+    def send_object(self, obj, schema):
+        """ queues an object for the client socket, encoded with 'schema' or as pickle string """
+        if self.closing:
+            return
+        if self.wire_schema:
+            pickle_str = zlib.compress(encode_message(schema, obj, self.wire_version))
+        else:
+            pickle_str = zlib.compress(pickle.dumps(obj))
+        self.out_buffer += struct.pack('!I%ds' % len(pickle_str), len(pickle_str), pickle_str)
+
+    def send_command(self, command):
+        """ queues a 1-byte command for the client socket """
+        if self.closing:
+            return
+        self.out_buffer += chr(command)
 
     def handle(self):
-        """ main server socket handle method """
-        
-        # pretty print client address
-        self.str_address = '%s:%d' % (self.client_address[0], self.client_address[1])
+        """ main exchange generator """
 
         # identify the connection purpose
-        command = self.recv_command()
-        if command is None:
+        command = yield RECV_COMMAND
+
+        # nodes using the schema wire format flag the command byte
+        self.wire_schema = command is not None and (command & WIRE_SCHEMA) != 0
+        if self.wire_schema:
+            command &= ~WIRE_SCHEMA
+        elif not accept_pickle and command in [Commands.HELLO, Commands.PLANETLAB, Commands.SESSION]:
+            logging.debug('ERROR: refusing pickled objects from %s' % self.str_address)
+            self.send_command(Commands.ERROR)
+            self.close_client_socket()
             return
 
         # command to reload the ec2 hosts file and request names file
@@ -263,6 +972,8 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler): # could use So
             self.send_command(Commands.OK)
             self.close_client_socket()
             refresh_config()
+            registry.rebuild()
+            self.server.push_node_info()
             return
             
         # command to shutdown server
@@ -282,18 +993,17 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler): # could use So
                 '#', 'HOSTNAME', 'SLOT', 'DELTA', 'SEEN', 'ADDR')
             now = time.time()
             count = 0
-            for node in slots:
-                if node is not None:
-                    count += 1
-                    nodes_str += ' %2d. %-45s %4d %7.3f %s %s\n' % (
-                        count,
-                        node['hostname'],
-                        node['slot'],
-                        node['delta'],
-                        time2str(now - node['last_seen']),
-                        node['address']
-                   )
-            start_ago = now - ThreadedTCPRequestHandler.start_time
+            for node in registry.get_nodes():
+                count += 1
+                nodes_str += ' %2d. %-45s %4d %7.3f %s %s\n' % (
+                    count,
+                    node['hostname'],
+                    node['slot'],
+                    node['delta'],
+                    time2str(now - node['last_seen']),
+                    node['address']
+               )
+            start_ago = now - ExchangeHandler.start_time
             start_ago_time = datetime.timedelta(days=start_ago/(3600*24), seconds=start_ago%(3600*24))
             next_delta = req_int - float(int(now * 1000) % int(req_int * 1000)) / 1000
             logging.info("""
@@ -301,84 +1011,103 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler): # could use So
 Server started on:            %s (%s ago)
 Current server time:          %s
 Next synchronization cycle:   %s (in %s)
+Open connections:             %d
+Open sessions:                %d
+Data writer:                  %s
+Slot schedule:                %s
 Known PlanetLab nodes:
 %s
 """ % (
-                time.ctime(ThreadedTCPRequestHandler.start_time), 
+                time.ctime(ExchangeHandler.start_time), 
                 str(start_ago_time),
                 time.ctime(now),
                 time.ctime(now + next_delta),
                 time2str(next_delta),
+                len(self.server.handlers),
+                len([handler for handler in self.server.handlers if handler.session is not None]),
+                writer.get_status(),
+                registry.get_status(),
                 nodes_str))
             return
             
         # a node is connecting to the server for the first time    
         if command == Commands.HELLO:
             logging.debug('Received HELLO from %s' % self.str_address)
-            greeting = self.recv_object()
+            greeting = yield (RECV_OBJECT, 'greeting')
+            recv_time = time.time()
             if greeting is None:
                 return
             node = self.assign_slot(greeting['hostname'])
             if node is None:
                 return
-            reply = {
-                'id': node['id'],
-                'slot': node['slot'],
-                'delta': node['delta'],
-                'req_int': req_int,
-                'now': time.time(),
-                'ec2hosts': ec2hosts,
-                'req_names': req_names
-            }
             self.send_command(Commands.OK)
-            self.send_object(reply)
+            self.send_object(get_node_info(node, recv_time=recv_time), 'node_info')
             self.close_client_socket()
             return
                 
-        # client sends data collected since last connection and server replies as above
+        # client sends data collected since last connection, in chunks acknowledged one by one, and
+        # server replies as above
         if command == Commands.PLANETLAB:
             logging.debug('Received PLANETLAB from %s' % self.str_address)
-            greeting = self.recv_object()
+            greeting = yield (RECV_OBJECT, 'greeting')
+            recv_time = time.time()
             if greeting is None:
                 return
-            node = find_node(greeting['id'])
-            if node is None: # if server does not know about node add it to 'slots[]'
-                slot = greeting['slot']
-                if slots[slot] is None: # restore node to same slot if it has been removed from 'slots[]'
-                    node = {
-                       'id': greeting['id'],
-                       'address': self.str_address,
-                       'last_seen': time.time(),
-                       'slot': slot,
-                       'delta': slot2time(slot),
-                       'hostname': greeting['hostname']
-                    }
-                    slots[slot] = node
-                else: # assign an empty slot, but with the same id
-                    node = self.assign_slot(greeting['hostname'])
-                    if node is None:
-                        return
-                    node['id'] = greeting['id'] 
-            else: # server knows about node; just update last seen time
-                node['last_seen'] = time.time()
-            reply = {
-                'id': node['id'],
-                'slot': node['slot'],
-                'delta': node['delta'],
-                'req_int': req_int,
-                'now': time.time(),
-                'ec2hosts': ec2hosts,
-                'req_names': req_names
-            }
+            node = self.restore_node(greeting)
+            if node is None:
+                return
+            self.stream = greeting.get('stream')
             self.send_command(Commands.OK)
-            self.send_object(reply)
-            data = self.recv_object()
-            if data is None:
+            self.send_object(get_node_info(node, self.stream, recv_time), 'node_info')
+            while True:
+                data = yield (RECV_OBJECT, 'data')
+                if data is None:
+                    return
+                # a refused chunk stays with the node, which sends it again on its next exchange
+                self.send_command(Commands.OK if self.commit_chunk(node, data) else Commands.ERROR)
+                if data.get('seq') is None: # older nodes send all records at once and expect us to close
+                    self.close_client_socket()
+                    return
+
+        # node keeps the connection open: it streams records as they are collected, each batch
+        # answered as above, and is pushed its node info (after REFRESH, or when the probe times
+        # it reports with a batch move it to another slot) preceded by a REFRESH byte; a batch
+        # carrying the time it was 'sent' at is also answered with when it was received, preceded
+        # by a CLOCK byte, for the node to keep estimating its clock offset
+        if command == Commands.SESSION:
+            logging.debug('Received SESSION from %s' % self.str_address)
+            greeting = yield (RECV_OBJECT, 'greeting')
+            recv_time = time.time()
+            if greeting is None:
+                return
+            node = self.restore_node(greeting)
+            if node is None:
                 return
+            self.stream = greeting.get('stream')
             self.send_command(Commands.OK)
-            self.close_client_socket()
-            store_data(node, data)
-            return
+            self.send_object(get_node_info(node, self.stream, recv_time), 'node_info')
+            self.session = node
+            self.timeout = session_timeout
+            while True:
+                command = yield RECV_COMMAND
+                if command != Commands.PLANETLAB:
+                    logging.debug('ERROR: unknown session command %s from %s' % (command, self.str_address))
+                    self.close_client_socket()
+                    return
+                data = yield (RECV_OBJECT, 'data')
+                recv_time = time.time()
+                if data is None:
+                    return
+                registry.touch(node)
+                self.send_command(Commands.OK if self.commit_chunk(node, data) else Commands.ERROR)
+                if data.get('sent') is not None:
+                    self.send_command(Commands.CLOCK)
+                    self.send_object({ 'sent': data['sent'], 'recv': recv_time, 'now': time.time() }, 'clock')
+                if data.get('probe_times') is not None and registry.update(node, data['probe_times']):
+                    self.send_command(Commands.REFRESH)
+                    self.send_object(get_node_info(node, self.stream), 'node_info')
+
+        logging.debug('ERROR: unknown command %s from %s' % (command, self.str_address))
 
 #---------------------------------------------------------------------------------------------------------------------
 
@@ -396,43 +1125,30 @@ if __name__ == "__main__":
     ensure_path(data_dir)
 
     refresh_config()
+
+    registry = NodeRegistry(nr_slots)
+
+    writer = DataWriter(SegmentStorage(data_dir) if storage_backend == 'segments' else TextStorage(data_dir))
+    writer.start()
     
-    server = ThreadedTCPServer((ip_addr, port), ThreadedTCPRequestHandler)
-    server.allow_reuse_address = True
-    server.init_shutdown = False
+    server = ExchangeServer((ip_addr, port))
     
     ip_addr, port = server.server_address
     
     logging.info('Starting awsping server on %s:%d..' % (ip_addr, port))
 
-    # Start a thread with the server -- that thread will then start one
-    # more thread for each request
-    server_thread = threading.Thread(target=server.serve_forever)
-    # Exit the server thread when the main thread terminates
-    server_thread.daemon = True
-    server_thread.start()
-    
-    logging.info('Server loop running in thread: %s' % server_thread.name)
-    
-    sec_count = 0
+    last_filter = time.time()
     try:
-        while True:
-            time.sleep(1)
-            sec_count += 1
-            if sec_count == 60:
-                sec_count = 0
-                filter_dead()
-            if server.init_shutdown:
-                break
+        while not server.init_shutdown:
+            asyncore.loop(timeout=1, use_poll=True, count=1)
+            server.check_timeouts()
+            if time.time() - last_filter >= 60:
+                last_filter = time.time()
+                registry.expire()
     except KeyboardInterrupt:
         pass
      
     logging.info('Shutting down..')
-    server.shutdown()
-    
-    
-
-
-
-
-
+    server.drain()
+    asyncore.close_all()
+    writer.stop()
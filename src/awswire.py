@@ -0,0 +1,278 @@
+#!/usr/bin/python
+
+# Wire formats shared by awsclient.py and awsserver.py; deployed to the PlanetLab nodes with the
+# client, so it must keep running on their Python (2.5 and up)
+
+import sys
+import struct
+import array
+import zlib
+
+#---------------------------------------------------------------------------------------------------------------------
+
+"""
+Schema wire format, used for objects exchanged after a HELLO or PLANETLAB command byte carrying the
+WIRE_SCHEMA flag (objects are pickled otherwise, as by older clients). A message is a u1 version
+followed by the fields of its schema that exist in that version, in order, each a u1 presence flag
+and, if present, its value:
+    int     = i8
+    float   = f8
+    str     = u4 length + bytes
+    strs    = lengths (u4 array, 0xFFFFFFFF for None) + concatenated bytes
+    floats  = f8 array
+    records = ec2host and request name tables (strs), then flat arrays of: ec2host entries per record,
+              ec2host index and number of timings per entry, request index and number of values per
+              timing, the timing values, and the trace time and (strs) output of every entry; since
+              version 3 the output is None for traces given as hop lists, which follow as arrays of
+              the number of hops of every entry (0xFFFF without one) and the hop number, (strs)
+              address and round trip time (-1 without one) of every hop; since version 5 arrays of
+              the clock offset and error bound (-1 without one) of every entry follow
+Since version 6 a chunk may carry the local time it was 'sent' at, which a session answers with a
+'clock' message, see Node.__read_session() of the client.
+An array is a u4 item count followed by the items; all numbers are in network byte order.
+"""
+
+WIRE_SCHEMA = 0x80 # command byte flag
+wire_version = 6 # version of the messages we send; all versions since 1 are decoded
+wire_schemas = { # (field, kind, version the field was added in)
+    'greeting': [('hostname', 'str', 1), ('id', 'str', 1), ('slot', 'int', 1), ('stream', 'str', 2),
+        ('probe_times', 'floats', 4)],
+    'node_info': [('id', 'str', 1), ('slot', 'int', 1), ('delta', 'float', 1), ('req_int', 'int', 1),
+        ('now', 'float', 1), ('ec2hosts', 'strs', 1), ('req_names', 'strs', 1), ('committed', 'int', 2),
+        ('recv', 'float', 5)],
+    'data': [('records', 'records', 1), ('seq', 'int', 2), ('probe_times', 'floats', 4), ('sent', 'float', 6)],
+    'clock': [('sent', 'float', 6), ('recv', 'float', 6), ('now', 'float', 6)]
+}
+wire_none = 0xFFFFFFFF
+wire_no_hops = 0xFFFF
+
+def pack_array(code, values):
+    items = array.array(code, values)
+    if sys.byteorder == 'little':
+        items.byteswap()
+    return struct.pack('!I', len(items)) + items.tostring()
+
+def unpack_array(code, body, offset):
+    count = struct.unpack_from('!I', body, offset)[0]
+    offset += 4
+    items = array.array(code)
+    size = items.itemsize * count
+    items.fromstring(body[offset:offset + size])
+    if sys.byteorder == 'little':
+        items.byteswap()
+    return items, offset + size
+
+def pack_strs(values):
+    lengths = [wire_none] * len(values)
+    for i, value in enumerate(values):
+        if value is not None:
+            lengths[i] = len(value)
+    return pack_array('I', lengths) + ''.join([value for value in values if value is not None])
+
+def unpack_strs(body, offset):
+    lengths, offset = unpack_array('I', body, offset)
+    values = list()
+    for length in lengths:
+        if length == wire_none:
+            values.append(None)
+        else:
+            values.append(body[offset:offset + length])
+            offset += length
+    return values, offset
+
+def hops2str(hops):
+    """ text of a hop list, for peers predating structured traces """
+    lines = list()
+    for hop, addr, rtt in hops:
+        if addr is None:
+            lines.append('%2d:  no reply' % hop)
+        elif rtt is None:
+            lines.append('%2d:  %s' % (hop, addr))
+        else:
+            lines.append('%2d:  %-40s %.3fms' % (hop, addr, rtt * 1000))
+    return '\n'.join(lines)
+
+def pack_records(records, version=wire_version):
+    tables = (list(), list()) # ec2hosts, requests
+    ids = (dict(), dict())
+    def get_id(table, name):
+        id = ids[table].get(name)
+        if id is None:
+            id = ids[table][name] = len(tables[table])
+            tables[table].append(name)
+        return id
+    record_sizes, entry_hosts, entry_sizes, time_reqs, time_sizes = [array.array('H') for i in range(5)]
+    values, trace_times = array.array('d'), array.array('d')
+    traces = list()
+    hop_counts, hop_nrs, hop_rtts, hop_addrs = array.array('H'), array.array('H'), array.array('d'), list()
+    clock_offsets, clock_errors = array.array('d'), array.array('d')
+    for record in records:
+        record_sizes.append(len(record))
+        for ec2host, record_data in record.items():
+            entry_hosts.append(get_id(0, ec2host))
+            entry_sizes.append(len(record_data['times']))
+            for request, timing in record_data['times'].items():
+                time_reqs.append(get_id(1, request))
+                time_sizes.append(len(timing))
+                values.extend(timing)
+            trace = record_data.get('trace') or [0.0, None]
+            trace_times.append(trace[0])
+            output = trace[1]
+            if isinstance(output, list) and version < 3:
+                output = hops2str(output)
+            if isinstance(output, list):
+                traces.append(None)
+                hop_counts.append(len(output))
+                for hop, addr, rtt in output:
+                    hop_nrs.append(hop)
+                    hop_addrs.append(addr)
+                    hop_rtts.append(-1.0 if rtt is None else rtt)
+            else:
+                traces.append(output)
+                hop_counts.append(wire_no_hops)
+            clock = record_data.get('clock') or [0.0, None]
+            clock_offsets.append(clock[0])
+            clock_errors.append(-1.0 if clock[1] is None else clock[1])
+    parts = [pack_strs(tables[0]), pack_strs(tables[1]), pack_array('H', record_sizes),
+        pack_array('H', entry_hosts), pack_array('H', entry_sizes), pack_array('H', time_reqs),
+        pack_array('H', time_sizes), pack_array('d', values), pack_array('d', trace_times), pack_strs(traces)]
+    if version >= 3:
+        parts.extend([pack_array('H', hop_counts), pack_array('H', hop_nrs), pack_strs(hop_addrs),
+            pack_array('d', hop_rtts)])
+    if version >= 5:
+        parts.extend([pack_array('d', clock_offsets), pack_array('d', clock_errors)])
+    return ''.join(parts)
+
+def unpack_records(body, offset, version=wire_version):
+    ec2hosts, offset = unpack_strs(body, offset)
+    requests, offset = unpack_strs(body, offset)
+    record_sizes, offset = unpack_array('H', body, offset)
+    entry_hosts, offset = unpack_array('H', body, offset)
+    entry_sizes, offset = unpack_array('H', body, offset)
+    time_reqs, offset = unpack_array('H', body, offset)
+    time_sizes, offset = unpack_array('H', body, offset)
+    values, offset = unpack_array('d', body, offset)
+    trace_times, offset = unpack_array('d', body, offset)
+    traces, offset = unpack_strs(body, offset)
+    hop_counts = None
+    if version >= 3:
+        hop_counts, offset = unpack_array('H', body, offset)
+        hop_nrs, offset = unpack_array('H', body, offset)
+        hop_addrs, offset = unpack_strs(body, offset)
+        hop_rtts, offset = unpack_array('d', body, offset)
+    clock_errors = None
+    if version >= 5:
+        clock_offsets, offset = unpack_array('d', body, offset)
+        clock_errors, offset = unpack_array('d', body, offset)
+    records = list()
+    entry = timing = value = hop = 0
+    for record_size in record_sizes:
+        record = dict()
+        for i in range(record_size):
+            times = dict()
+            for j in range(entry_sizes[entry]):
+                times[requests[time_reqs[timing]]] = values[value:value + time_sizes[timing]].tolist()
+                value += time_sizes[timing]
+                timing += 1
+            record_data = { 'times': times }
+            output = traces[entry]
+            if hop_counts is not None and hop_counts[entry] != wire_no_hops:
+                output = list()
+                for k in range(hop, hop + hop_counts[entry]):
+                    output.append([hop_nrs[k], hop_addrs[k], hop_rtts[k] if hop_rtts[k] >= 0 else None])
+                hop += hop_counts[entry]
+            if output is not None:
+                record_data['trace'] = [trace_times[entry], output]
+            if clock_errors is not None and clock_errors[entry] >= 0:
+                record_data['clock'] = [clock_offsets[entry], clock_errors[entry]]
+            record[ec2hosts[entry_hosts[entry]]] = record_data
+            entry += 1
+        records.append(record)
+    return records, offset
+
+def encode_message(schema, obj, version=wire_version):
+    """ encodes the fields of dictionary 'obj' listed in wire_schemas[schema] for peers of 'version' """
+    parts = [chr(version)]
+    for field, kind, since in wire_schemas[schema]:
+        if since > version:
+            continue
+        value = obj.get(field)
+        if value is None:
+            parts.append('\x00')
+            continue
+        parts.append('\x01')
+        if kind == 'int':
+            parts.append(struct.pack('!q', value))
+        elif kind == 'float':
+            parts.append(struct.pack('!d', value))
+        elif kind == 'str':
+            parts.append(struct.pack('!I', len(value)) + value)
+        elif kind == 'strs':
+            parts.append(pack_strs(value))
+        elif kind == 'floats':
+            parts.append(pack_array('d', value))
+        else:
+            parts.append(pack_records(value, version))
+    return ''.join(parts)
+
+def decode_message(schema, body):
+    """ decodes a message encoded by encode_message() into a dictionary """
+    version = ord(body[0])
+    if not 1 <= version <= wire_version:
+        raise ValueError('unsupported wire format version %d' % version)
+    obj = dict()
+    offset = 1
+    for field, kind, since in wire_schemas[schema]:
+        if since > version: # field added after the version of the message
+            obj[field] = None
+            continue
+        present = body[offset] != '\x00'
+        offset += 1
+        if not present:
+            obj[field] = None
+        elif kind == 'int':
+            obj[field] = struct.unpack_from('!q', body, offset)[0]
+            offset += 8
+        elif kind == 'float':
+            obj[field] = struct.unpack_from('!d', body, offset)[0]
+            offset += 8
+        elif kind == 'str':
+            length = struct.unpack_from('!I', body, offset)[0]
+            obj[field] = body[offset + 4:offset + 4 + length]
+            offset += 4 + length
+        elif kind == 'strs':
+            obj[field], offset = unpack_strs(body, offset)
+        elif kind == 'floats':
+            values, offset = unpack_array('d', body, offset)
+            obj[field] = values.tolist()
+        else:
+            obj[field], offset = unpack_records(body, offset, version)
+    return obj
+
+
+#---------------------------------------------------------------------------------------------------------------------
+
+class FrameDecoder():
+    """ decompresses a frame body of known size piece by piece as it is received """
+
+    def __init__(self, size, max_frame_size, max_object_size):
+        if size > max_frame_size:
+            raise ValueError('frame of %d bytes exceeds max_frame_size' % size)
+        self.remaining = size
+        self.max_object_size = max_object_size
+        self.decompressor = zlib.decompressobj()
+        self.parts = list()
+        self.size = 0 # decompressed bytes so far
+
+    def feed(self, data):
+        self.remaining -= len(data)
+        part = self.decompressor.decompress(data, self.max_object_size - self.size + 1)
+        self.size += len(part)
+        if self.size > self.max_object_size:
+            raise ValueError('frame decompresses to more than max_object_size bytes')
+        self.parts.append(part)
+
+    def finish(self):
+        """ the complete decompressed body """
+        self.parts.append(self.decompressor.flush())
+        return ''.join(self.parts)
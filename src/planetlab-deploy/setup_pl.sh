@@ -3,12 +3,14 @@
 cd ~
 
 rm -f awsclient.py
+rm -f awswire.py
 rm -f start_pl.sh
 rm -f kill_pl.sh
 rm -f startup_add.sh
 rm -f startup_remove.sh
 
 wget http://avs4.web.rice.edu/awsping/awsclient.py
+wget http://avs4.web.rice.edu/awsping/awswire.py
 wget http://avs4.web.rice.edu/awsping/start_pl.sh
 wget http://avs4.web.rice.edu/awsping/kill_pl.sh
 wget http://avs4.web.rice.edu/awsping/startup_add.sh
@@ -5,7 +5,12 @@ from collections import defaultdict
 import sys
 import os
 import json
-import pickle
+import array
+import struct
+import shutil
+import multiprocessing
+import heapq
+import numpy as np
 import wx
 import resource
 import time
@@ -14,7 +19,11 @@ import xmlrpclib
 
 data_dirs = ['data0/', 'data/']
 out_dir = 'plots/'
-pickle_blob = 'pickles.dat'
+store_dir = 'store/' # columnar measurement store, see MeasurementStore
+incremental = True # only parse data appended to node files since the store was last updated
+ingest_workers = None # processes parsing node data files in parallel (None = one per core, 1 = serial)
+render_workers = None # processes rendering plots in parallel (None = one per core, 1 = in the main process)
+sketch_alpha = 0.005 # relative error of the quantile sketches behind CDFs and percentiles
 plhosts_file = 'plhosts.json'
 
 global plhosts_info # init in __main__
@@ -41,6 +50,8 @@ def day_remap(timestamp):
     return time_remap_0 + time_struct.tm_hour * 3600 + time_struct.tm_min * 60 - 12 * 3600
 
 def area_mapper(plhost):
+    if plhost not in plhosts_info: # a node missing from plhosts_file
+        return 'Unknown'
     lat, long = plhosts_info[plhost]['latitude'], plhosts_info[plhost]['longitude']
     if lat > 22 and long < -30:
         return 'North America'
@@ -53,8 +64,16 @@ def area_mapper(plhost):
     if long >= 40:
         return 'Asia'
 
+area_names = ['North America', 'South America', 'Europe', 'Africa', 'Asia', None, 'Unknown'] # area codes index this list
+
+def get_area_codes(plhosts):
+    """ dense plhost id -> area code array, so per-sample area lookups become array indexing """
+    return np.array([area_names.index(area_mapper(plhost)) for plhost in plhosts], dtype=np.uint8)
+
 def plarea_filter(accepted_areas):
-    return (lambda plhost: area_mapper(plhost) in accepted_areas)
+    pred = lambda plhost: area_mapper(plhost) in accepted_areas
+    pred.area_codes = [area_names.index(area) for area in accepted_areas] # lets get_plhost_mask use codes
+    return pred
 
 
 #---------------------------------------------------------------------------------------------------------------------
@@ -452,6 +471,40 @@ for max_cost in range(85, 130, 5):
     }
 ]
 
+sweeps = [
+    {
+        'filename': 'file128k-3h-large-[asian]',
+        'plfilter': [],
+        'ec2filter': [remove_failure],
+        'timefilter': [remove_datagap],
+        'valuefilter': [],
+        'params': cost_large_asian_params(None),
+        'budgets': range(85, 130, 5),
+        'request': '/requests/file128k'
+    }
+]
+
+percentile_dump = [
+    {
+        'filename': 'file1k',
+        'plfilter': [],
+        'ec2filter': [remove_failure],
+        'timefilter': [remove_datagap],
+        'valuefilter': [],
+        'percentiles': [0.5, 0.9, 0.95, 0.99],
+        'request': '/requests/file1k'
+    },
+    {
+        'filename': 'file128k',
+        'plfilter': [],
+        'ec2filter': [remove_failure],
+        'timefilter': [remove_datagap],
+        'valuefilter': [],
+        'percentiles': [0.5, 0.9, 0.95, 0.99],
+        'request': '/requests/file128k'
+    }
+]
+
 csv_dump = [
     {
         'filename': 'file1k',
@@ -517,8 +570,8 @@ def load_plhosts_info(filename):
 
 def compute_plhosts_stats(plhosts):
     stats = defaultdict(int)
-    for host in plhosts:
-        stats[area_mapper(host)] += 1
+    for code in get_area_codes(plhosts):
+        stats[area_names[code]] += 1
     return stats
 
 
@@ -526,40 +579,264 @@ def compute_plhosts_stats(plhosts):
 # Parsing
 #---------------------------------------------------------------------------------------------------------------------
 
-def collect_data(data_folder_list):
-    all_data = defaultdict(dict)
-    plhosts_list = list()
-    plhosts_dict = dict()
+"""
+Columnar measurement store layout (one directory):
+
+    meta.json       name tables (request, ec2host and plhost names, indexed by id),
+                    the [request_id, ec2host_id, begin, end] row ranges and the number of
+                    bytes already collected from each node data file ('sources')
+    request.npy     uint16 request id of each measurement
+    ec2host.npy     uint16 ec2host id
+    plhost.npy      uint16 plhost id
+    minute.npy      int64 start time truncated to the minute
+    conn.npy        float64 connection duration
+    get.npy         float64 GET duration
+    dns.npy, connect.npy, first_byte.npy, body.npy, warm_first_byte.npy, warm_body.npy
+                    float32 phases of the request (see HttpFetch in awsclient.py), NaN where
+                    not measured, as by older clients and in stores written before them
+
+Rows are sorted by (request, ec2host, minute) so every (request, ec2host) pair is a
+contiguous range that can be sliced out of the memory-mapped columns without copying.
+
+Data folders hold either one JSON-lines text file per node or, when the server ran with its
+'segments' storage backend, binary segments 'seg-NNNNNN.bin' whose records index the names in
+the folder's 'names.jsonl' (see SegmentStorage in awsserver.py); segments are memory-mapped.
+"""
 
+store_tables = ['requests', 'ec2hosts', 'plhosts']
+store_columns = [
+    ('request', 'H', np.uint16),
+    ('ec2host', 'H', np.uint16),
+    ('plhost', 'H', np.uint16),
+    ('minute', 'l', np.int64),
+    ('conn', 'd', np.float64),
+    ('get', 'd', np.float64),
+    ('dns', 'f', np.float32),
+    ('connect', 'f', np.float32),
+    ('first_byte', 'f', np.float32),
+    ('body', 'f', np.float32),
+    ('warm_first_byte', 'f', np.float32),
+    ('warm_body', 'f', np.float32)
+]
+store_phases = ['dns', 'connect', 'first_byte', 'body', 'warm_first_byte', 'warm_body'] # timing values 3 to 8
+store_meta = 'meta.json'
+
+segment_magic = 'AWSG'
+segment_header = struct.Struct('<4sHH')
+segment_footer = struct.Struct('<Qdd4s')
+segment_footer_magic = 'AWSX'
+segment_fields = [('node', '<u4'), ('ec2host', '<u2'), ('request', '<u2'), ('start', '<f8'), ('conn', '<f4'), ('get', '<f4')]
+segment_dtypes = { # segment version -> record layout
+    1: np.dtype(segment_fields),
+    2: np.dtype(segment_fields + [(phase, '<f4') for phase in store_phases])
+}
+segment_sidecars = ['names.jsonl', 'traces.jsonl', 'clocks.jsonl']
+
+
+def intern_name(table, ids, name):
+    """ returns the id of 'name' in 'table', appending it if not seen before """
+    id = ids.get(name)
+    if id is None:
+        id = len(table)
+        table.append(name)
+        ids[name] = id
+    return id
+
+
+def sort_columns(columns):
+    order = np.lexsort((columns['minute'], columns['ec2host'], columns['request']))
+    return dict((name, values[order]) for name, values in columns.items())
+
+
+def parse_data_file(job):
+    """
+    parses the complete lines of a node data file past byte 'offset' into partial columns whose
+    request and ec2host ids index the file-local name tables; runs in ingestion worker processes
+    """
+    fullname, offset = job
+    names = dict((table, list()) for table in ['requests', 'ec2hosts'])
+    ids = dict((table, dict()) for table in names)
+    columns = dict((name, array.array(code)) for name, code, dtype in store_columns if name != 'plhost')
+    with open(fullname, 'r') as f:
+        f.seek(offset)
+        line_nr = 0 if offset == 0 else 3 # the 3-line header is only at the start of the file
+        while True:
+            line = f.readline()
+            if not line.endswith('\n'): # EOF, or a record the server is still writing
+                break
+            offset += len(line)
+            line_nr += 1
+            if line_nr <= 3:
+                continue
+            record = json.loads(line.strip())
+            for ec2host, record_data in record.items():
+                ec2host_id = intern_name(names['ec2hosts'], ids['ec2hosts'], ec2host)
+                for request, timing_value in record_data['times'].items():
+                    columns['request'].append(intern_name(names['requests'], ids['requests'], request))
+                    columns['ec2host'].append(ec2host_id)
+                    columns['minute'].append(int(timing_value[0]) // 60 * 60)
+                    columns['conn'].append(timing_value[1])
+                    columns['get'].append(timing_value[2])
+                    for i, phase in enumerate(store_phases):
+                        columns[phase].append(timing_value[3 + i] if len(timing_value) > 3 + i else np.nan)
+    return offset, names, dict((name, np.array(columns[name], dtype=dtype))
+        for name, code, dtype in store_columns if name != 'plhost')
+
+
+def read_segment_names(dirname):
+    """ name tables of the ids used by the segments in 'dirname' """
+    tables = {'node': 'plhosts', 'ec2host': 'ec2hosts', 'request': 'requests'}
+    names = dict((table, list()) for table in store_tables)
+    with open(os.path.join(dirname, 'names.jsonl'), 'r') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            kind, id, name = json.loads(line)
+            table = names[tables[kind]]
+            table.extend([None] * (id + 1 - len(table)))
+            table[id] = name
+    return names
+
+
+def parse_segment_file(job):
+    """
+    maps the records of a segment past byte 'offset' into partial columns whose ids index the name
+    tables of its folder; records of a segment the server is still writing are read up to the last
+    complete one
+    """
+    fullname, offset = job
+    with open(fullname, 'rb') as f:
+        magic, version, record_size = segment_header.unpack(f.read(segment_header.size))
+        segment_dtype = segment_dtypes.get(version)
+        if magic != segment_magic or segment_dtype is None or record_size != segment_dtype.itemsize:
+            raise ValueError('%s is not a segment of a known version' % fullname)
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        end = size
+        if size >= segment_header.size + segment_footer.size:
+            f.seek(size - segment_footer.size)
+            count, first, last, magic = segment_footer.unpack(f.read(segment_footer.size))
+            if magic == segment_footer_magic and \
+                    segment_header.size + count * record_size + segment_footer.size == size:
+                end = size - segment_footer.size
+    offset = max(offset, segment_header.size)
+    count = max(0, end - offset) // record_size
+    if count > 0:
+        records = np.memmap(fullname, dtype=segment_dtype, mode='r', offset=offset, shape=(count,))
+    else:
+        records = np.zeros(0, dtype=segment_dtype)
+    columns = {
+        'request': records['request'].astype(np.uint16),
+        'ec2host': records['ec2host'].astype(np.uint16),
+        'plhost': records['node'].astype(np.uint32),
+        'minute': records['start'].astype(np.int64) // 60 * 60,
+        'conn': records['conn'].astype(np.float64),
+        'get': records['get'].astype(np.float64)
+    }
+    for phase in store_phases:
+        if phase in segment_dtype.names:
+            columns[phase] = records[phase].astype(np.float32)
+        else:
+            columns[phase] = np.empty(count, dtype=np.float32)
+            columns[phase].fill(np.nan)
+    new_offset = size if end < size else offset + count * record_size
+    return new_offset, read_segment_names(os.path.dirname(fullname)), columns
+
+
+def parse_source(job):
+    fullname, offset = job
+    if fullname.endswith('.bin'):
+        return parse_segment_file(job)
+    return parse_data_file(job)
+
+
+def collect_data(data_folder_list, base=None, workers=None):
+    """
+    parses node data files into sorted columns; if 'base' is given (tables and 'sources' byte
+    offsets of an existing store), only data appended since then is parsed and ids are kept stable;
+    with more than one worker, files are parsed in a process pool and merged in the serial order
+    """
+    workers = workers or ingest_workers or multiprocessing.cpu_count()
+    data = dict((table, list(base[table]) if base else list()) for table in store_tables)
+    ids = dict((table, dict((name, id) for id, name in enumerate(data[table]))) for table in store_tables)
+    data['sources'] = dict(base.get('sources', dict())) if base else dict()
+
+    jobs = list()
     for data_folder in data_folder_list:
         print('\n--- Collecting data from %s..' % data_folder)
-        for filename in os.listdir(data_folder):
+        for filename in sorted(os.listdir(data_folder)):
+            if filename in segment_sidecars:
+                continue
             fullname = os.path.join(data_folder, filename)
-            print('Reading %s..  [mem usage: %d KB]' % (fullname, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
-            plhost = os.path.splitext(filename)[0]
-            with open(fullname, 'r') as f:
-                line_nr = 0
-                for line in f:
-                    line_nr += 1
-                    if line_nr <= 3:
-                        continue
-                    record = json.loads(line.strip())
-                    for ec2host, record_data in record.items():
-                        for request, timing_value in record_data['times'].items():
-                            if ec2host not in all_data[request]:
-                                all_data[request][ec2host] = defaultdict(list)
-                            minute = int(timing_value[0]) // 60 * 60
-                            all_data[request][ec2host][minute].append((plhost, timing_value[2]))
+            offset = data['sources'].get(fullname, 0)
+            size = os.path.getsize(fullname)
+            if size == offset:
+                continue
+            if size < offset:
+                print('WARNING: %s shrank below the %d bytes already collected, skipping' % (fullname, offset))
+                continue
+            print('Reading %s from byte %d..' % (fullname, offset))
+            jobs.append((fullname, offset))
+
+    print('\n--- Parsing %d files using %d worker(s)..' % (len(jobs), workers))
+    pool = multiprocessing.Pool(workers) if workers > 1 and len(jobs) > 1 else None
+    partials = pool.imap(parse_source, jobs) if pool else (parse_source(job) for job in jobs)
+    parts = dict((name, list()) for name, code, dtype in store_columns)
+    try:
+        for (fullname, offset), (new_offset, names, columns) in zip(jobs, partials):
+            if 'plhost' not in columns: # a node data file only holds measurements of the node it is named after
+                names['plhosts'] = [os.path.splitext(os.path.basename(fullname))[0]]
+                columns['plhost'] = np.zeros(len(columns['get']), dtype=np.uint16)
+            # intern names in file order, so ids match a serial parse whatever the worker count
+            for name, table in [('request', 'requests'), ('ec2host', 'ec2hosts'), ('plhost', 'plhosts')]:
+                id_map = np.array([intern_name(data[table], ids[table], n) for n in names[table]], dtype=np.uint16)
+                parts[name].append(id_map[columns[name]] if len(id_map) else columns[name])
+            for name in ['minute', 'conn', 'get'] + store_phases:
+                parts[name].append(columns[name])
+            data['sources'][fullname] = new_offset
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    print('    Done! [mem usage: %d KB]' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
 
     print('\n--- Sorting times..')
-    all_data_sorted = dict()
-    for request, time_records in all_data.items():
-        all_data_sorted[request] = dict()
-        for ec2host, records in time_records.items():
-            timestamps = sorted(list(records.keys()))
-            all_data_sorted[request][ec2host] = [(timestamp, records[timestamp]) for timestamp in timestamps]
+    data['columns'] = sort_columns(dict((name, np.concatenate(parts[name]).astype(dtype) if parts[name] else np.array([], dtype=dtype))
+        for name, code, dtype in store_columns))
+    return data
 
-    return all_data_sorted
+
+def update_data(dirname, data_folder_list):
+    """ incrementally ingests new node data into the store at 'dirname', creating it if needed """
+    if not os.path.exists(os.path.join(dirname, store_meta)):
+        store_data(collect_data(data_folder_list), dirname)
+        return
+    with open(os.path.join(dirname, store_meta), 'r') as f:
+        base = json.load(f)
+    if 'sources' not in base: # written before incremental updates, merging would collect everything twice
+        print('\n--- Store %s has no collected offsets, rebuilding it..' % dirname)
+        store_data(collect_data(data_folder_list), dirname)
+        return
+    data = collect_data(data_folder_list, base)
+    new_count = len(data['columns']['get'])
+    if new_count == 0 and data['sources'] == base.get('sources', dict()):
+        print('\n--- Store %s is up to date' % dirname)
+        return
+    print('\n--- Merging %d new records into %s..' % (new_count, dirname))
+    columns = data['columns']
+    data['columns'] = sort_columns(dict((name, np.concatenate((load_column(dirname, name, dtype), columns[name])))
+        for name, code, dtype in store_columns))
+    store_data(data, dirname)
+
+
+def load_column(dirname, name, dtype, mmap_mode=None):
+    """ a column of the store at 'dirname'; phases missing from stores written before them are NaN """
+    filename = os.path.join(dirname, name + '.npy')
+    if os.path.exists(filename) or name not in store_phases:
+        return np.load(filename, mmap_mode=mmap_mode)
+    values = np.empty(len(np.load(os.path.join(dirname, 'get.npy'), mmap_mode='r')), dtype=dtype)
+    values.fill(np.nan)
+    return values
 
 
 def ensure_path(path):
@@ -570,18 +847,74 @@ def ensure_path(path):
         pass
 
 
-def store_data(data, filename):
-    print('\n--- Storing data to %s..' % filename)
-    with open(filename, 'wb') as f:
-        pickle.dump(data, f)
-    print('    Done! [file size: %d KB]' % (os.path.getsize(filename) // 1024))
+def get_store_index(columns):
+    """ computes the [request_id, ec2host_id, begin, end] row range of every (request, ec2host) pair """
+    if len(columns['request']) == 0:
+        return list()
+    keys = columns['request'].astype(np.int64) << 16 | columns['ec2host']
+    bounds = np.flatnonzero(np.diff(keys)) + 1
+    begins = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(keys)]))
+    return [[int(columns['request'][b]), int(columns['ec2host'][b]), int(b), int(e)]
+        for b, e in zip(begins, ends)]
+
+
+def store_data(data, dirname):
+    """ writes a complete store next to 'dirname' and then swaps it in place of the old one """
+    print('\n--- Storing data to %s..' % dirname)
+    dirname = dirname.rstrip('/')
+    tmpname = dirname + '.tmp'
+    if os.path.exists(tmpname):
+        shutil.rmtree(tmpname)
+    ensure_path(tmpname)
+    columns = data['columns']
+    for name, code, dtype in store_columns:
+        np.save(os.path.join(tmpname, name + '.npy'), columns[name])
+    meta = dict((table, data[table]) for table in store_tables)
+    meta['sources'] = data.get('sources', dict())
+    meta['index'] = get_store_index(columns)
+    with open(os.path.join(tmpname, store_meta), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(dirname):
+        os.rename(dirname, dirname + '.old')
+        os.rename(tmpname, dirname)
+        shutil.rmtree(dirname + '.old')
+    else:
+        os.rename(tmpname, dirname)
+    size = sum(os.path.getsize(os.path.join(dirname, filename)) for filename in os.listdir(dirname))
+    print('    Done! [%d records, store size: %d KB]' % (len(columns['get']), size // 1024))
 
 
-def load_data(filename):
-    print('\n--- Loading data from %s..' % filename)
-    with open(filename, 'rb') as f:
-        data = pickle.load(f)
-    print('    Done! [mem usage: %d KB]' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+class MeasurementStore:
+    """ read-only view of a columnar store directory; columns are memory-mapped, not loaded """
+
+    def __init__(self, dirname):
+        with open(os.path.join(dirname, store_meta), 'r') as f:
+            meta = json.load(f)
+        for table in store_tables:
+            setattr(self, table, meta[table])
+        self.columns = dict((name, load_column(dirname, name, dtype, 'r')) for name, code, dtype in store_columns)
+        self.index = dict(((self.requests[r], self.ec2hosts[e]), (b, end)) for r, e, b, end in meta['index'])
+        self.plhost_areas = None # plhost id -> area code, set by load_data
+
+    def __len__(self):
+        return len(self.columns['get'])
+
+    def get_ec2hosts(self, request):
+        """ ec2hosts which have measurements for 'request' """
+        return [ec2host for req, ec2host in self.index if req == request]
+
+    def select(self, request, ec2host, names=None):
+        """ column slices (views into the mapped files) for one (request, ec2host) pair """
+        begin, end = self.index.get((request, ec2host), (0, 0))
+        return dict((name, self.columns[name][begin:end]) for name in (names or self.columns.keys()))
+
+
+def load_data(dirname):
+    print('\n--- Loading data from %s..' % dirname)
+    data = MeasurementStore(dirname)
+    data.plhost_areas = get_area_codes(data.plhosts)
+    print('    Done! [%d records, mem usage: %d KB]' % (len(data), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
     return data
 
 
@@ -594,38 +927,107 @@ def admit_one(filters, elem):
     return True
 
 
-def filter_data(data, plot_desc):
-    print('\n--- Filtering data..')
+def admit_mask(filters, values, convert=None):
+    """ boolean mask of 'values' admitted by 'filters'; each distinct value is tested only once """
+    if not filters:
+        return np.ones(len(values), dtype=bool)
+    uniques, inverse = np.unique(values, return_inverse=True)
+    accepted = np.array([admit_one(filters, convert(val) if convert else val) for val in uniques], dtype=bool)
+    return accepted[inverse]
+
+
+def select_columns(data, plot_desc):
+    """
+    selects the measurements of plot_desc['request'] accepted by its ec2filter and timefilter as
+    per-ec2host 'minute', 'plhost', 'get' and 'area' (index in area_names) columns, sorted by minute
+    """
+    print('\n--- Selecting data..')
     assert plot_desc['request'] is not None
-    to_filter = data[plot_desc['request']]
-    plhosts = set()
+    selected = dict()
+    for ec2host in data.get_ec2hosts(plot_desc['request']):
+        if not admit_one(plot_desc['ec2filter'], ec2host):
+            continue
+        columns = data.select(plot_desc['request'], ec2host, ['minute', 'plhost', 'get'])
+        mask = admit_mask(plot_desc['timefilter'], columns['minute'], int)
+        selected[ec2host] = dict((name, np.array(values[mask])) for name, values in columns.items())
+        selected[ec2host]['area'] = data.plhost_areas[selected[ec2host]['plhost']]
+    return selected
+
+
+def iter_columns(data, plot_desc, chunk_rows=1 << 20):
+    """
+    streams the measurements of plot_desc['request'] accepted by all its filters as
+    (ec2host, columns) chunks of at most 'chunk_rows' store rows, using bounded memory
+    """
+    pl_accepted = get_plhost_mask(data, plot_desc)
+    for ec2host in data.get_ec2hosts(plot_desc['request']):
+        if not admit_one(plot_desc['ec2filter'], ec2host):
+            continue
+        columns = data.select(plot_desc['request'], ec2host, ['minute', 'plhost', 'get'])
+        for begin in range(0, len(columns['get']), chunk_rows):
+            chunk = dict((name, values[begin:begin + chunk_rows]) for name, values in columns.items())
+            mask = pl_accepted[chunk['plhost']]
+            mask &= admit_mask(plot_desc['timefilter'], chunk['minute'], int)
+            mask &= admit_mask(plot_desc['valuefilter'], chunk['get'], float)
+            chunk = dict((name, values[mask]) for name, values in chunk.items())
+            chunk['area'] = data.plhost_areas[chunk['plhost']]
+            yield ec2host, chunk
+
+
+def get_plhost_mask(data, plot_desc):
+    """ boolean array telling which plhost ids plot_desc['plfilter'] accepts """
+    pl_accepted = np.ones(len(data.plhosts), dtype=bool)
+    pl_filters = list()
+    for pred in plot_desc['plfilter']:
+        if hasattr(pred, 'area_codes'):
+            pl_accepted &= np.in1d(data.plhost_areas, pred.area_codes)
+        else:
+            pl_filters.append(pred)
+    if pl_filters:
+        pl_accepted &= np.array([admit_one(pl_filters, plhost) for plhost in data.plhosts], dtype=bool)
+    return pl_accepted
+
+
+def refine_columns(data, selected, plot_desc):
+    """ applies the plfilter and valuefilter of 'plot_desc' to columns from select_columns """
+    print('\n--- Filtering data..')
+    pl_accepted = get_plhost_mask(data, plot_desc)
+    plhost_ids = set()
     filtered = dict()
-    for ec2host, records in to_filter.items():
-        if admit_one(plot_desc['ec2filter'], ec2host):
-            filtered[ec2host] = list()
-            for time_records in to_filter[ec2host]:
-                if admit_one(plot_desc['timefilter'], time_records[0]):
-                    acc_times = list()
-                    for time in time_records[1]:
-                        if (admit_one(plot_desc['plfilter'], time[0]) and
-                            admit_one(plot_desc['valuefilter'], time[1])):
-                            plhosts.add(time[0])
-                            acc_times.append(time)
-                    if len(acc_times) > 0:
-                        filtered[ec2host].append((time_records[0], acc_times))
-
-    return filtered, plhosts
-
-
-def remap_time(data, time_map):
+    for ec2host, columns in selected.items():
+        mask = pl_accepted[columns['plhost']]
+        mask &= admit_mask(plot_desc['valuefilter'], columns['get'], float)
+        filtered[ec2host] = dict((name, values[mask]) for name, values in columns.items())
+        plhost_ids.update(np.unique(filtered[ec2host]['plhost']))
+    return filtered, set(data.plhosts[id] for id in plhost_ids)
+
+
+def to_records(data, filtered):
+    """ converts filtered columns to the {ec2host: [(minute, [(plhost, seconds), ..]), ..]} layout """
+    records = dict()
+    for ec2host, columns in filtered.items():
+        records[ec2host] = list()
+        minutes = columns['minute']
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(minutes)) + 1, [len(minutes)]))
+        for begin, end in zip(bounds[:-1], bounds[1:]):
+            if begin < end:
+                records[ec2host].append((int(minutes[begin]), [(data.plhosts[plhost], float(value))
+                    for plhost, value in zip(columns['plhost'][begin:end], columns['get'][begin:end])]))
+    return records
+
+
+def remap_columns(filtered, time_map):
+    """ remaps the 'minute' column of filtered columns, keeping them sorted by the new times """
     if time_map is None:
-        return data
-    for ec2host, records in data.items():
-        time_dict = defaultdict(list)
-        for record in records:
-            time_dict[time_map(record[0])] += record[1]
-        data[ec2host] = sorted(time_dict.items(), key=lambda x: x[0])
-    return data
+        return filtered
+    remapped = dict()
+    for ec2host, columns in filtered.items():
+        uniques, inverse = np.unique(columns['minute'], return_inverse=True)
+        minutes = np.array([time_map(int(minute)) for minute in uniques], dtype=np.int64)[inverse]
+        order = np.argsort(minutes, kind='mergesort')
+        remapped[ec2host] = dict((name, values[order]) for name, values in columns.items())
+        remapped[ec2host]['minute'] = minutes[order]
+    return remapped
 
 
 def remap_plhosts(data, plhost_map):
@@ -642,9 +1044,9 @@ def remap_plhosts(data, plhost_map):
 # Data analysis
 #---------------------------------------------------------------------------------------------------------------------
 
-def plot(records, plhosts, plot_desc):
+def plot(records, plhosts, plot_desc, cache=None):
     if plot_desc['params']['type'] == 'LINE':
-        do_plot_timeline(records, plot_desc)
+        do_plot_timeline(records, plot_desc, cache)
 
     if plot_desc['params']['type'] == 'RANK':
         pass
@@ -667,189 +1069,323 @@ def time_str(timestamp, weekday=True, date=True, hour=True):
         str += time.strftime(' %H:%M', time_struct)
     return str[1:]
 
-"""
-def get_avg_response(records, time, interval):
-    if time < records[0][0] or time > records[-1][0]:
-        return 0, 0
-    sum_time = 0
-    count_time = 0
+def get_window_averages(columns, times, interval, distrib=None):
+    """
+    average response times and sample counts of the windows [time - interval/2, time + interval/2]
+    centered on each of 'times', for one ec2host; every window is two prefix sum lookups
+    when 'distrib' is given, per-area averages are weighted by the area share of the users
+    """
+    minutes = columns['minute']
+    avgs = np.zeros(len(times))
+    counts = np.zeros(len(times), dtype=np.int64)
+    if len(minutes) == 0:
+        return avgs, counts
     half_int = float(interval) / 2
-    min_bound = 0
-    max_bound = len(records) - 1
-    mid_bound = None
-    while max_bound >= min_bound:
-        mid_bound = (min_bound + max_bound) // 2
-        if records[mid_bound][0] < time:
-            min_bound = mid_bound + 1
-        elif records[mid_bound][0] > time:
-            max_bound = mid_bound - 1
-        else:
-            break
-    min_bound = mid_bound
-    while min_bound >= 0 and records[min_bound][0] >= (time - half_int):
-        min_bound -= 1
-    max_bound = mid_bound
-    while max_bound < len(records) and records[max_bound][0] <= (time + half_int):
-        max_bound += 1
-    for i in range(min_bound + 1, max_bound):
-        if (time - half_int) <= records[i][0] <= (time + half_int):
-            sum_time += sum(timing[1] for timing in records[i][1])
-            count_time += len(records[i][1])
-    if count_time == 0:
-        return 0, 0
-    return sum_time / float(count_time), count_time
-"""
-
-def get_avg_response(records, time, interval, distrib=None):
-    if time < records[0][0] or time > records[-1][0]:
-        return 0, 0
-    sum_time = 0
-    count_time = 0
-    half_int = float(interval) / 2
-    min_bound = 0
-    max_bound = len(records) - 1
-    mid_bound = None
-    while max_bound >= min_bound:
-        mid_bound = (min_bound + max_bound) // 2
-        if records[mid_bound][0] < time:
-            min_bound = mid_bound + 1
-        elif records[mid_bound][0] > time:
-            max_bound = mid_bound - 1
-        else:
-            break
-    min_bound = mid_bound
-    while min_bound >= 0 and records[min_bound][0] >= (time - half_int):
-        min_bound -= 1
-    max_bound = mid_bound
-    while max_bound < len(records) and records[max_bound][0] <= (time + half_int):
-        max_bound += 1
-    totals = dict()
-    for i in range(min_bound + 1, max_bound):
-        if (time - half_int) <= records[i][0] <= (time + half_int):
-            for timing in records[i][1]:
-                pl_area = area_mapper(timing[0])
-                sum_area, count_area = totals.get(pl_area, (0, 0))
-                totals[pl_area] = (sum_area + timing[1], count_area + 1)
-    w_avg = 0
-    count_time = 0
-    for area, p_total in totals.items():
-        if distrib is not None and area not in distrib:
-            continue
-        if distrib is None:
-            w_avg += p_total[0]
-        else:
-            w_avg += float(p_total[0]) / p_total[1] * distrib[area]
-        count_time += p_total[1]
-    if count_time == 0:
-        return 0, 0
+    lo = np.searchsorted(minutes, times - half_int, 'left')
+    hi = np.searchsorted(minutes, times + half_int, 'right')
     if distrib is None:
-        w_avg /= count_time
+        sums = np.concatenate(([0], np.cumsum(columns['get'])))
+        counts = hi - lo
+        avgs = (sums[hi] - sums[lo]) / np.maximum(counts, 1)
     else:
-        w_avg /= float(sum(distrib.values())) # should be 1
-    return w_avg, count_time
+        for area, weight in distrib.items():
+            in_area = columns['area'] == area_names.index(area)
+            sums = np.concatenate(([0], np.cumsum(np.where(in_area, columns['get'], 0))))
+            area_counts = np.concatenate(([0], np.cumsum(in_area)))
+            area_counts = area_counts[hi] - area_counts[lo]
+            avgs += (sums[hi] - sums[lo]) / np.maximum(area_counts, 1) * weight
+            counts += area_counts
+        avgs /= float(sum(distrib.values())) # should be 1
+    outside = (times < minutes[0]) | (times > minutes[-1]) | (counts == 0)
+    avgs[outside] = 0
+    counts[outside] = 0
+    return avgs, counts
 
 
 def get_ranking_timeline(times, plot_desc, valid_count=50):
     print('\n--- Computing timeline..')
-    min_time = min(val[0][0] for val in times.values())
-    max_time = max(val[-1][0] for val in times.values())
-    timeline = defaultdict(list)
-    min_val = None
-    max_val = None
-
-    for time in range(int(min_time), int(max_time), plot_desc['params']['step']):
-        data_point = list()
-        for ec2host, records in times.items():
-            avg_time, count_time = get_avg_response(records, time, plot_desc['params']['interval'], plot_desc['params']['distrib'])
-            if count_time < valid_count:
-                timeline[ec2host].append((None, None, count_time))
-            else:
-                data_point.append((ec2host, avg_time, count_time))
-                if max_val is None or avg_time > max_val:
-                    max_val = avg_time
-                if min_val is None or avg_time < min_val:
-                    min_val = avg_time
-        data_point = sorted(data_point, key=lambda x: x[1])
-        for i, entry in enumerate(data_point):
-            timeline[entry[0]].append((i, entry[1], entry[2]))
-
+    min_time = min(columns['minute'][0] for columns in times.values() if len(columns['minute']))
+    max_time = max(columns['minute'][-1] for columns in times.values() if len(columns['minute']))
+    steps = np.arange(int(min_time), int(max_time), plot_desc['params']['step'])
+    hosts = times.keys()
+
+    avgs = np.zeros((len(hosts), len(steps)))
+    counts = np.zeros((len(hosts), len(steps)), dtype=np.int64)
+    for i, ec2host in enumerate(hosts):
+        avgs[i], counts[i] = get_window_averages(times[ec2host], steps,
+            plot_desc['params']['interval'], plot_desc['params']['distrib'])
+    valid = counts >= valid_count
+    # stable sort over hosts, so ties rank in the same order as the hosts are iterated
+    order = np.argsort(np.where(valid, avgs, np.inf), axis=0, kind='mergesort')
+    ranks = np.empty_like(order)
+    ranks[order, np.arange(len(steps))] = np.arange(len(hosts))[:, np.newaxis]
+
+    timeline = dict()
+    for i, ec2host in enumerate(hosts):
+        timeline[ec2host] = [(int(ranks[i, j]), float(avgs[i, j]), int(counts[i, j])) if valid[i, j]
+            else (None, None, int(counts[i, j])) for j in range(len(steps))]
+    min_val = float(avgs[valid].min()) if valid.any() else None
+    max_val = float(avgs[valid].max()) if valid.any() else None
     return timeline, min_time, max_time, min_val, max_val
 
 
-def get_cdf(records, plot_desc):
+def get_timeline_key(params):
+    return ('timeline', params['timeremap'], params['step'], params['interval'],
+        tuple(sorted(params['distrib'].items())) if params['distrib'] else None)
+
+
+def get_timeline(records, plot_desc, cache=None):
+    """ get_ranking_timeline of the remapped records, memoized in 'cache' by the timeline params """
+    params = plot_desc['params']
+    if cache is None:
+        cache = dict()
+    remap_key = ('remap', params['timeremap'])
+    if remap_key not in cache:
+        cache[remap_key] = remap_columns(records, params['timeremap'])
+    timeline_key = get_timeline_key(params)
+    if timeline_key not in cache:
+        cache[timeline_key] = get_ranking_timeline(cache[remap_key], plot_desc)
+    return cache[timeline_key]
+
+
+class QuantileSketch:
+    """
+    mergeable log-bucketed histogram: a value v > 0 is counted in bucket ceil(log(v) / log(gamma)),
+    so quantiles and CDFs have a relative error of at most 'alpha' in O(log(max/min) / alpha) memory
+    """
+
+    def __init__(self, alpha=None):
+        self.alpha = alpha or sketch_alpha
+        self.gamma = (1 + self.alpha) / (1 - self.alpha)
+        self.log_gamma = np.log(self.gamma)
+        self.min_key = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.zero_count = 0 # values <= 0
+
+    def __len__(self):
+        return int(self.zero_count + self.counts.sum())
+
+    def get_keys(self, values):
+        return np.ceil(np.log(values) / self.log_gamma).astype(np.int64)
+
+    def add_counts(self, min_key, counts):
+        if len(counts) == 0:
+            return
+        if len(self.counts) == 0:
+            self.min_key, self.counts = min_key, np.array(counts, dtype=np.int64)
+            return
+        new_min = min(self.min_key, min_key)
+        new_len = max(self.min_key + len(self.counts), min_key + len(counts)) - new_min
+        merged = np.zeros(new_len, dtype=np.int64)
+        merged[self.min_key - new_min:self.min_key - new_min + len(self.counts)] += self.counts
+        merged[min_key - new_min:min_key - new_min + len(counts)] += counts
+        self.min_key, self.counts = new_min, merged
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        positive = values > 0
+        self.zero_count += int(len(values) - positive.sum())
+        if positive.any():
+            keys = self.get_keys(values[positive])
+            min_key = int(keys.min())
+            self.add_counts(min_key, np.bincount(keys - min_key))
+        return self
+
+    def merge(self, other):
+        assert self.alpha == other.alpha
+        self.zero_count += other.zero_count
+        self.add_counts(other.min_key, other.counts)
+        return self
+
+    def quantile(self, q):
+        rank = q * (len(self) - 1)
+        if rank < self.zero_count:
+            return 0.0
+        bucket = np.searchsorted(np.cumsum(self.counts), rank - self.zero_count, 'right')
+        return 2 * self.gamma ** (self.min_key + bucket) / (self.gamma + 1)
+
+    def cdf(self, values):
+        """ fractions of the sketched values which are <= each of 'values' """
+        values = np.asarray(values, dtype=np.float64)
+        below = np.concatenate(([0], np.cumsum(self.counts)))
+        buckets = self.get_keys(np.maximum(values, np.finfo(float).tiny)) - self.min_key
+        fractions = (self.zero_count + below[np.clip(buckets + 1, 0, len(self.counts))]) / float(max(1, len(self)))
+        fractions[values < 0] = 0
+        return fractions
+
+
+def sketch_columns(records, alpha=None):
+    return dict((ec2host, QuantileSketch(alpha).add(columns['get'])) for ec2host, columns in records.items())
+
+
+def get_cdf(sketches, plot_desc):
     print('\n--- Computing CDF..')
-    cdf_data = dict()
-    time_values = dict()
-
-    for ec2host, time_records in records.items():
-        values = list()
-        for timestamp, request_times in time_records:
-            for timing in request_times:
-                values.append(timing[1])
-        values = sorted(values)
-        time_values[ec2host] = values
-
     range_min = plot_desc['params']['range'][0]
     range_max = plot_desc['params']['range'][1]
-    min_val = min(v[int(range_min * len(v))] for v in time_values.values())
-    max_val = max(v[int(range_max * len(v))-1] for v in time_values.values())
-    step_val = (max_val - min_val) / float(plot_desc['params']['steps'])
-
-    for ec2host, values in time_values.items():
-        total_count = len(values)
-        cdf_vals = list()
-        next_val = min_val
-        curr_count = 0
-        while next_val <= max_val:
-            while values[curr_count] <= next_val:
-                curr_count += 1
-            cdf_vals.append(float(curr_count-1)/total_count)
-            next_val += step_val
-        cdf_data[ec2host] = cdf_vals
+    min_val = min(sketch.quantile(range_min) for sketch in sketches.values())
+    max_val = max(sketch.quantile(range_max) for sketch in sketches.values())
+    steps = min_val + (max_val - min_val) * np.arange(plot_desc['params']['steps'] + 1) / float(plot_desc['params']['steps'])
+    cdf_data = dict((ec2host, list(sketch.cdf(steps))) for ec2host, sketch in sketches.items())
     return cdf_data, min_val, max_val
 
 
-def get_location_plan(timeline, plot_desc):
+def get_cost_hull(options):
+    """
+    lower convex hull of the (cost, response, ec2host) options of one time point, ordered from the
+    fastest option to the cheapest; moving along it, each dollar saved costs ever more response time
+    """
+    frontier = list()
+    for option in sorted(options, key=lambda o: (o[1], o[0])):
+        if len(frontier) == 0 or option[0] < frontier[-1][0]: # drop options not cheaper than a faster one
+            frontier.append(option)
+    hull = list()
+    for option in frontier:
+        # drop the last point if going straight from the one before it to 'option' is more efficient
+        while len(hull) >= 2 and ((hull[-1][1] - hull[-2][1]) * (hull[-1][0] - option[0]) >=
+                                  (option[1] - hull[-1][1]) * (hull[-2][0] - hull[-1][0])):
+            hull.pop()
+        hull.append(option)
+    return hull
+
+
+def get_location_frontier(timeline, plot_desc):
+    """
+    starts from the fastest ec2host at every time point and repeatedly applies the cheapest swap
+    in response time per dollar saved, taken from a priority queue holding the next move along
+    each time point's cost hull, down to the cheapest plan; returns the fastest plan, the list of
+    (time point, ec2host) moves, the (cost, average response) frontier before and after each move
+    and the {ec2host: (cost, response)} options of every time point
+    """
     nr_points = len(timeline[timeline.keys()[0]]) # assume all lengths equal
-    hosts = sorted_ec2hosts(timeline.keys())
-    max_cost = plot_desc['params']['maxcost']
     cost_map = plot_desc['params']['costs']
     step_h = plot_desc['params']['step'] / float(3600)
-    fast_cost = 0
-    for ec2host, times in timeline.items():
-        for pt in times:
-            if pt[0] == 0: # rank 1
-                fast_cost += lookup_cost(ec2host, cost_map) * step_h
-    print('fast_cost=%.3f max_cost=%.3f' % (fast_cost, max_cost))
-
-    loc = [''] * nr_points
-    for ec2host, times in timeline.items():
-        for i, pt in enumerate(times):
-            if pt[0] == 0: # rank 1
-                loc[i] = ec2host
-
-    if max_cost >= fast_cost:
-        return loc
-
-    curr_cost = fast_cost
-    while curr_cost > max_cost:
-        # find best savings
-        best_saving = None
-        for i in range(nr_points):
-            for ec2host, times in timeline.items():
-                opp_cost = (lookup_cost(loc[i], cost_map) - lookup_cost(ec2host, cost_map)) * step_h
-                if opp_cost > 0:
-                    opp_resp = timeline[loc[i]][i][1] - times[i][1]
-                    opp_total = opp_cost / opp_resp
-                    if best_saving is None or opp_total > best_saving[2]:
-                        best_saving = (i, ec2host, opp_total, opp_cost)
-        # apply it
-        if best_saving is None:
-            print('min_cost=%.3f reached' % curr_cost)
-            break
-        curr_cost -= best_saving[3]
-        loc[best_saving[0]] = best_saving[1]
-        print('curr_cost=%.3f' % curr_cost)
+
+    options = [dict((ec2host, (lookup_cost(ec2host, cost_map) * step_h, times[i][1]))
+        for ec2host, times in timeline.items() if times[i][1] is not None) for i in range(nr_points)]
+    hulls = [get_cost_hull([(cost, resp, ec2host) for ec2host, (cost, resp) in options[i].items()])
+        for i in range(nr_points)]
+    fast_loc = [hull[0][2] if hull else '' for hull in hulls]
+    nr_valid = max(1, sum(1 for hull in hulls if hull))
+    curr_cost = sum(hull[0][0] for hull in hulls if hull)
+    curr_resp = sum(hull[0][1] for hull in hulls if hull)
+
+    def next_move(i, k):
+        """ (response increase per dollar saved, time point, hull position) of moving past hull[k] """
+        curr, cheaper = hulls[i][k], hulls[i][k+1]
+        return ((cheaper[1] - curr[1]) / (curr[0] - cheaper[0]), i, k)
+
+    queue = [next_move(i, 0) for i in range(nr_points) if len(hulls[i]) > 1]
+    heapq.heapify(queue)
+    moves = list()
+    frontier = [(curr_cost, curr_resp / nr_valid)]
+    while queue:
+        rate, i, k = heapq.heappop(queue)
+        curr_cost -= hulls[i][k][0] - hulls[i][k+1][0]
+        curr_resp += hulls[i][k+1][1] - hulls[i][k][1]
+        moves.append((i, hulls[i][k+1][2]))
+        frontier.append((curr_cost, curr_resp / nr_valid))
+        if k + 2 < len(hulls[i]):
+            heapq.heappush(queue, next_move(i, k + 1))
+    return fast_loc, moves, frontier, options
+
+
+def fill_location_plan(loc, options, spare):
+    """
+    spends the 'spare' budget a frontier plan leaves below its budget on moves of single time points
+    to faster ec2hosts, the one saving the most response time that still fits first, as the next
+    frontier move may save far more than needed; returns the extra cost and the response time saved
+    """
+    extra = saved = 0.0
+    while True:
+        best = None
+        for i, choices in enumerate(options):
+            if loc[i] not in choices:
+                continue
+            curr_cost, curr_resp = choices[loc[i]]
+            for ec2host, (cost, resp) in choices.items():
+                if resp < curr_resp and cost - curr_cost <= spare - extra and \
+                        (best is None or curr_resp - resp > best[0]):
+                    best = (curr_resp - resp, cost - curr_cost, i, ec2host)
+        if best is None:
+            return extra, saved
+        saved += best[0]
+        extra += best[1]
+        loc[best[2]] = best[3]
+
+
+def trim_location_plan(loc, options, excess):
+    """
+    moves the one time point of 'loc' which saves at least 'excess' for the least response time added;
+    returns the cost saved and the response time added, None if no single move saves enough
+    """
+    best = None
+    for i, choices in enumerate(options):
+        if loc[i] not in choices:
+            continue
+        curr_cost, curr_resp = choices[loc[i]]
+        for ec2host, (cost, resp) in choices.items():
+            if curr_cost - cost >= excess and (best is None or resp - curr_resp < best[1]):
+                best = (curr_cost - cost, resp - curr_resp, i, ec2host)
+    if best is None:
+        return None
+    loc[best[2]] = best[3]
+    return best[:2]
+
+
+def get_location_plans(frontier_data, budgets):
+    """
+    derives the plan of every budget from one get_location_frontier run, each cheaper budget
+    continuing from the frontier plan of the previous one; as frontier plans only fall on the
+    budget by chance, the plan before the last move is also brought within it by another single
+    move (trim_location_plan), both spend what is left with fill_location_plan, and the faster
+    is taken; returns {budget: (loc, cost, average response)}
+    """
+    fast_loc, moves, frontier, options = frontier_data
+    nr_valid = max(1, sum(1 for choices in options if choices))
+    loc = list(fast_loc)
+    plans = dict()
+    applied = 0
+    prev = None # frontier plan before the last move applied, over the budget
+    print('fast_cost=%.3f min_cost=%.3f' % (frontier[0][0], frontier[-1][0]))
+    for budget in sorted(budgets, reverse=True):
+        while frontier[applied][0] > budget and applied < len(moves):
+            i, ec2host = moves[applied]
+            prev = (list(loc), frontier[applied])
+            loc[i] = ec2host
+            applied += 1
+        if frontier[applied][0] > budget:
+            print('max_cost=%.3f below min_cost=%.3f' % (budget, frontier[applied][0]))
+        plan = list(loc)
+        cost, resp = frontier[applied]
+        extra, saved = fill_location_plan(plan, options, budget - cost)
+        plans[budget] = (plan, cost + extra, resp - saved / nr_valid)
+        if prev is not None:
+            plan, (cost, resp) = list(prev[0]), prev[1]
+            trim = trim_location_plan(plan, options, cost - budget)
+            if trim is not None:
+                cost, resp = cost - trim[0], resp + trim[1] / nr_valid
+                extra, saved = fill_location_plan(plan, options, budget - cost)
+                if resp - saved / nr_valid < plans[budget][2]:
+                    plans[budget] = (plan, cost + extra, resp - saved / nr_valid)
+    return plans
+
+
+def get_frontier(timeline, plot_desc, cache=None):
+    """ get_location_frontier memoized in 'cache' by the timeline and cost params """
+    params = plot_desc['params']
+    if cache is None:
+        cache = dict()
+    frontier_key = ('frontier', get_timeline_key(params), params['step'], tuple(sorted(params['costs'].items())))
+    if frontier_key not in cache:
+        print('Computing location frontier..')
+        cache[frontier_key] = get_location_frontier(timeline, plot_desc)
+    return cache[frontier_key]
+
+
+def get_location_plan(timeline, plot_desc, cache=None):
+    max_cost = plot_desc['params']['maxcost']
+    loc, cost, resp = get_location_plans(get_frontier(timeline, plot_desc, cache), [max_cost])[max_cost]
+    print('max_cost=%.3f curr_cost=%.3f avg_resp=%.3f' % (max_cost, cost, resp))
     return loc
 
 
@@ -1097,9 +1633,8 @@ def get_significant_values(val_min, val_max, count=4):
 # Plot methods
 #---------------------------------------------------------------------------------------------------------------------
 
-def do_plot_timeline(records, plot_desc):
-    records = remap_time(records, plot_desc['params']['timeremap'])
-    timeline, start_time, end_time, val_min, val_max = get_ranking_timeline(records, plot_desc)
+def do_plot_timeline(records, plot_desc, cache=None):
+    timeline, start_time, end_time, val_min, val_max = get_timeline(records, plot_desc, cache)
 
     print('\n--- Plotting timeline..')
 
@@ -1188,7 +1723,7 @@ def do_plot_timeline(records, plot_desc):
         marker_size = 5 * Res.scale
         bar_h = 5 * Res.scale
         print('Computing location plan..')
-        loc = get_location_plan(timeline, plot_desc)
+        loc = get_location_plan(timeline, plot_desc, cache)
         print('Plotting location plan..')
         for i in range(nr_points):
             pos_x = zero_x + ptspacing_w * i
@@ -1204,7 +1739,7 @@ def do_plot_timeline(records, plot_desc):
 
 
 def do_plot_cdf(records, plot_desc):
-    cdf_data, val_min, val_max = get_cdf(records, plot_desc)
+    cdf_data, val_min, val_max = get_cdf(sketch_columns(records), plot_desc)
 
     print('\n--- Plotting CDF..')
 
@@ -1311,30 +1846,172 @@ def dump_csv(records, filename, request):
                     ))
 
 
+def dump_percentiles(data, plot_desc):
+    """
+    writes per-ec2host percentiles of the response times, for each PlanetLab area and overall, from
+    one streaming pass over the store; the overall sketch is the merge of the per-area ones
+    """
+    print('\n--- Sketching response times..')
+    sketches = defaultdict(dict)
+    for ec2host, chunk in iter_columns(data, plot_desc):
+        for code in np.unique(chunk['area']):
+            sketch = sketches[ec2host].setdefault(area_names[code], QuantileSketch())
+            sketch.add(chunk['get'][chunk['area'] == code])
+    filename = os.path.join(out_dir, 'percentiles-%s.csv' % plot_desc['filename'])
+    print('\n--- Saving %s..' % filename)
+    with open(filename, 'w') as f:
+        for ec2host in sorted_ec2hosts(sketches.keys()):
+            overall = QuantileSketch()
+            for area, sketch in sorted(sketches[ec2host].items()):
+                overall.merge(sketch)
+            for area, sketch in sorted(sketches[ec2host].items()) + [('All', overall)]:
+                f.write('%s, %s, %d, %s\n' % (ec2host, area, len(sketch),
+                    ', '.join('%.4f' % sketch.quantile(q) for q in plot_desc['percentiles'])))
+
+
+def dump_sweep(records, plhosts, plot_desc, cache=None):
+    """
+    writes the cost -> average response frontier of a location plan sweep and the plan of
+    each of plot_desc['budgets'], computing the timeline and the frontier only once
+    """
+    timeline = get_timeline(records, plot_desc, cache)[0]
+    frontier_data = get_frontier(timeline, plot_desc, cache)
+    filename = os.path.join(out_dir, 'frontier-%s.csv' % plot_desc['filename'])
+    print('\n--- Saving %s..' % filename)
+    with open(filename, 'w') as f:
+        for cost, resp in frontier_data[2]:
+            f.write('%.3f, %.4f\n' % (cost, resp))
+    filename = os.path.join(out_dir, 'plans-%s.csv' % plot_desc['filename'])
+    print('\n--- Saving %s..' % filename)
+    plans = get_location_plans(frontier_data, plot_desc['budgets'])
+    with open(filename, 'w') as f:
+        for budget in sorted(plans.keys()):
+            loc, cost, resp = plans[budget]
+            f.write('%.1f, %.3f, %.4f, %s\n' % (budget, cost, resp, ', '.join(get_short_ec2hosts(loc))))
+
+
+#---------------------------------------------------------------------------------------------------------------------
+# Execution
+#---------------------------------------------------------------------------------------------------------------------
+
+def stage_key(plot_desc, stages):
+    """ identifies the data produced by the given filter stages; area filters compare by their codes """
+    def pred_key(pred):
+        return ('area', tuple(sorted(pred.area_codes))) if hasattr(pred, 'area_codes') else pred
+    return tuple(tuple(pred_key(pred) for pred in plot_desc[stage] or []) for stage in stages)
+
+
+def plan_plots(plot_descs):
+    """
+    groups descriptors into [(selection_desc, [(filter_desc, [descs..]), ..]), ..]: all descs of
+    a selection share request, ec2filter and timefilter, all descs of a filter group also share
+    plfilter and valuefilter; groups keep the order in which they first appear
+    """
+    plan = list()
+    selections = dict()
+    for plot_desc in plot_descs:
+        select_key = (plot_desc['request'],) + stage_key(plot_desc, ['ec2filter', 'timefilter'])
+        filter_key = stage_key(plot_desc, ['plfilter', 'valuefilter'])
+        if select_key not in selections:
+            selections[select_key] = (plot_desc, list(), dict())
+            plan.append(selections[select_key][:2])
+        groups, group_index = selections[select_key][1:]
+        if filter_key not in group_index:
+            group_index[filter_key] = (plot_desc, list())
+            groups.append(group_index[filter_key])
+        group_index[filter_key][1].append(plot_desc)
+    return plan
+
+
+render_jobs = None # (render, records, plhosts, plot_desc, cache) of a parallel plan, inherited by forked workers
+
+def init_render_worker():
+    """ sets up wx drawing resources; called once in the main process or in each render worker """
+    global wx_app
+    wx_app = wx.App()
+    wx_app.MainLoop()
+    Res.init()
+
+
+def run_render_job(index):
+    render, records, plhosts, plot_desc, cache = render_jobs[index]
+    print('\n\n=== Processing %s..' % plot_desc['filename'])
+    render(records, plhosts, plot_desc, cache)
+    return plot_desc['filename']
+
+
+def prepare_plot(records, plhosts, plot_desc, cache):
+    """ fills 'cache' with the intermediate results of a plot that other plots may share """
+    if plot_desc['params']['type'] == 'LINE':
+        timeline = get_timeline(records, plot_desc, cache)[0]
+        if 'costs' in plot_desc['params']:
+            get_frontier(timeline, plot_desc, cache)
+
+
+def execute_plan(data, plan, render, prepare=None, workers=1):
+    """
+    computes each distinct dataset of a plan once and hands it to render(records, plhosts, desc, cache);
+    with more than one worker, datasets and shared results (see 'prepare') are computed first and the
+    descriptors are then rendered by a pool of forked processes, which share them copy-on-write
+    """
+    global render_jobs
+    workers = workers or multiprocessing.cpu_count()
+    jobs = list()
+    for select_desc, groups in plan:
+        selected = select_columns(data, select_desc)
+        for filter_desc, plot_descs in groups:
+            records, plhosts = refine_columns(data, selected, filter_desc)
+            cache = dict() # intermediate results shared by the plots of this dataset
+            for plot_desc in plot_descs:
+                if workers > 1:
+                    if prepare is not None:
+                        prepare(records, plhosts, plot_desc, cache)
+                    jobs.append((render, records, plhosts, plot_desc, cache))
+                else:
+                    print('\n\n=== Processing %s..' % plot_desc['filename'])
+                    render(records, plhosts, plot_desc, cache)
+    if len(jobs) == 0:
+        return
+    print('\n\n=== Rendering %d plots using %d workers..' % (len(jobs), workers))
+    render_jobs = jobs
+    pool = multiprocessing.Pool(workers, initializer=init_render_worker)
+    try:
+        for filename in pool.imap_unordered(run_render_job, range(len(jobs))):
+            print('\n=== Done %s' % filename)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        render_jobs = None
+
+
 #---------------------------------------------------------------------------------------------------------------------
 # Main
 #---------------------------------------------------------------------------------------------------------------------
 
 if __name__ == '__main__':
-    app = wx.App()
-    app.MainLoop()
-    Res.init()
+    workers = render_workers or multiprocessing.cpu_count()
+    if workers == 1: # plots are rendered in this process
+        init_render_worker()
     ensure_path(out_dir)
     if not os.path.exists(plhosts_file):
         store_plhosts_info(get_plhosts_info(), plhosts_file)
-    if not os.path.exists(pickle_blob):
-        store_data(collect_data(data_dirs), pickle_blob)
+    if incremental:
+        update_data(store_dir, data_dirs)
+    elif not os.path.exists(store_dir):
+        store_data(collect_data(data_dirs), store_dir)
     plhosts_info = load_plhosts_info(plhosts_file)
-    all_data = load_data(pickle_blob)
-    for plot_desc in plots:
-        print('\n\n=== Processing plot %s..' % plot_desc['filename'])
-        records, plhosts = filter_data(all_data, plot_desc)
-        #print(compute_plhosts_stats(plhosts))
-        plot(records, plhosts, plot_desc)
-    for plot_desc in csv_dump:
-        print('\n\n=== Processing dataset %s..' % plot_desc['filename'])
-        records, plhosts = filter_data(all_data, plot_desc)
-        dump_csv(records, 'dump-%s.csv' % plot_desc['filename'], plot_desc['filename'])
+    all_data = load_data(store_dir)
+    execute_plan(all_data, plan_plots(plots), plot, prepare_plot, workers)
+    execute_plan(all_data, plan_plots(sweeps), dump_sweep)
+    for plot_desc in percentile_dump:
+        print('\n\n=== Processing percentiles %s..' % plot_desc['filename'])
+        dump_percentiles(all_data, plot_desc)
+    execute_plan(all_data, plan_plots(csv_dump),
+        lambda records, plhosts, plot_desc, cache: dump_csv(to_records(all_data, records),
+            'dump-%s.csv' % plot_desc['filename'], plot_desc['filename']))
     print('\n=== All done!\n')
 
 
@@ -0,0 +1,91 @@
+#!/usr/bin/python2.7
+
+"""
+location plan checks; run with: python2.7 test/test_plots.py
+"""
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import plots
+except ImportError: # plots needs Python 2.7, numpy and wx
+    plots = None
+
+
+def get_greedy_plan(timeline, cost_map, max_cost):
+    """ the location plan of older plots.py versions: the best cost saving per response time first """
+    nr_points = len(timeline.values()[0])
+    loc = [''] * nr_points
+    for ec2host, times in timeline.items():
+        for i, pt in enumerate(times):
+            if pt[0] == 0: # rank 1
+                loc[i] = ec2host
+    curr_cost = sum(plots.lookup_cost(ec2host, cost_map) for ec2host in loc)
+    while curr_cost > max_cost:
+        best_saving = None
+        for i in range(nr_points):
+            for ec2host, times in timeline.items():
+                opp_cost = plots.lookup_cost(loc[i], cost_map) - plots.lookup_cost(ec2host, cost_map)
+                if opp_cost > 0:
+                    opp_total = opp_cost / (timeline[loc[i]][i][1] - times[i][1])
+                    if best_saving is None or opp_total > best_saving[2]:
+                        best_saving = (i, ec2host, opp_total, opp_cost)
+        if best_saving is None:
+            break
+        curr_cost -= best_saving[3]
+        loc[best_saving[0]] = best_saving[1]
+    return loc
+
+
+@unittest.skipIf(plots is None, 'plots needs Python 2.7, numpy and wx')
+class LocationPlanTest(unittest.TestCase):
+
+    def get_case(self, rng):
+        """ random (timeline, cost map, budgets) with no missing samples and an hour per time point """
+        regions = ['region%d' % i for i in range(rng.randint(2, 4))]
+        cost_map = dict((region, round(rng.uniform(0.05, 0.5), 2)) for region in regions)
+        ec2hosts = ['host%d.%s' % (i, rng.choice(regions)) for i in range(rng.randint(2, 8))]
+        nr_points = rng.randint(2, 20)
+        resp = dict((ec2host, [rng.uniform(1.0, 20.0) for i in range(nr_points)]) for ec2host in ec2hosts)
+        timeline = dict()
+        for ec2host in ec2hosts:
+            timeline[ec2host] = [(sorted([resp[other][i] for other in ec2hosts]).index(resp[ec2host][i]),
+                resp[ec2host][i]) for i in range(nr_points)]
+        costs = [plots.lookup_cost(ec2host, cost_map) * nr_points for ec2host in ec2hosts]
+        budgets = [rng.uniform(min(costs), max(costs)) for i in range(4)]
+        return timeline, cost_map, budgets
+
+    def evaluate(self, loc, timeline, cost_map):
+        return (sum(plots.lookup_cost(ec2host, cost_map) for ec2host in loc),
+            sum(timeline[ec2host][i][1] for i, ec2host in enumerate(loc)) / float(len(loc)))
+
+    def test_plans_match_or_beat_greedy(self):
+        rng = random.Random(1)
+        stdout = sys.stdout
+        for case in range(300):
+            timeline, cost_map, budgets = self.get_case(rng)
+            plot_desc = { 'params': { 'costs': cost_map, 'step': 3600 } }
+            sys.stdout = open(os.devnull, 'w') # plots prints its progress
+            try:
+                plans = plots.get_location_plans(plots.get_location_frontier(timeline, plot_desc), budgets)
+                greedy = dict((budget, get_greedy_plan(timeline, cost_map, budget)) for budget in budgets)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            for budget in budgets:
+                loc, cost, resp = plans[budget]
+                self.assertAlmostEqual(cost, self.evaluate(loc, timeline, cost_map)[0])
+                self.assertAlmostEqual(resp, self.evaluate(loc, timeline, cost_map)[1])
+                greedy_cost, greedy_resp = self.evaluate(greedy[budget], timeline, cost_map)
+                if greedy_cost <= budget:
+                    self.assertTrue(cost <= budget + 1e-9, 'case %d over budget %.3f' % (case, budget))
+                    self.assertTrue(resp <= greedy_resp + 1e-9, 'case %d slower than greedy at budget %.3f: %.3f > %.3f' %
+                        (case, budget, resp, greedy_resp))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/python2.7
+
+"""
+NodeRegistry checks; run with: python2.7 test/test_registry.py
+"""
+
+import os
+import sys
+import random
+import logging
+import unittest
+
+logging.getLogger('').addHandler(logging.NullHandler()) # keeps awsserver from logging to a file
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import awsserver
+except ImportError: # the server runs on Python 2.7
+    awsserver = None
+
+
+class Clock():
+    """ stands in for the time module of awsserver, so request intervals pass without waiting """
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+@unittest.skipIf(awsserver is None, 'awsserver needs Python 2.7')
+class NodeRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((name, getattr(awsserver, name)) for name in
+            ['time', 'ec2hosts', 'req_names', 'req_int', 'nr_slots', 'max_host_concurrency', 'move_margin', 'move_hold'])
+        self.clock = Clock()
+        awsserver.time = self.clock
+        awsserver.ec2hosts = ['host%d' % i for i in range(5)]
+        awsserver.req_names = ['/requests/file1k', '/requests/file128k']
+        awsserver.req_int = 900
+        awsserver.nr_slots = 512
+        awsserver.max_host_concurrency = 4
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(awsserver, name, value)
+
+    def report(self, registry, nodes, base_times, rng):
+        """ one request interval passes and every node reports its probe times with +/-25% jitter; moves made """
+        self.clock.now += awsserver.req_int
+        moved = list()
+        for node, times in zip(nodes, base_times):
+            if registry.update(node, [t * rng.uniform(0.75, 1.25) for t in times]):
+                moved.append(node['id'])
+        return moved
+
+    def test_jitter_does_not_move_nodes(self):
+        rng = random.Random(1)
+        base_times = [[rng.uniform(0.5, 4.0) for host in awsserver.ec2hosts] for i in range(300)]
+        registry = awsserver.NodeRegistry(awsserver.nr_slots)
+        nodes = [registry.add('node%d' % i, 'x', probe_times=times) for i, times in enumerate(base_times)]
+        last_moved = dict()
+        for interval in range(8):
+            moved = self.report(registry, nodes, base_times, rng)
+            self.assertTrue(len(moved) <= len(nodes) / 100, 'interval %d moved %d nodes' % (interval, len(moved)))
+            for id in moved:
+                self.assertTrue(interval - last_moved.get(id, -awsserver.move_hold) >= awsserver.move_hold)
+                last_moved[id] = interval
+
+    def test_move_margin_and_hold(self):
+        registry = awsserver.NodeRegistry(awsserver.nr_slots)
+        first = registry.add('first', 'x', probe_times=[1.0] * 5)
+        node = registry.add('node', 'x', slot=first['slot'] + 1, probe_times=[1.0] * 5)
+        self.assertEqual(node['slot'], first['slot'] + 1)
+        # longer probes of 'node' overlap those of 'first', but a free slot would lower its peak only by 1
+        awsserver.max_host_concurrency = 1
+        awsserver.move_margin = 2
+        self.assertFalse(registry.update(node, [3.0] * 5))
+        self.assertEqual(node['slot'], first['slot'] + 1)
+        awsserver.move_margin = 1
+        self.assertTrue(registry.update(node, [3.5] * 5))
+        self.assertNotEqual(node['slot'], first['slot'] + 1)
+        # once moved, the node stays in its slot for 'move_hold' intervals even if it is over the ceiling again
+        awsserver.max_host_concurrency = 4
+        registry.add('third', 'x', slot=node['slot'] + 1, probe_times=[1.0] * 5)
+        awsserver.max_host_concurrency = 1
+        slot = node['slot']
+        self.clock.now += (awsserver.move_hold - 1) * awsserver.req_int
+        self.assertFalse(registry.update(node, [4.0] * 5))
+        self.assertEqual(node['slot'], slot)
+        self.clock.now += awsserver.req_int
+        self.assertTrue(registry.update(node, [4.5] * 5))
+        self.assertNotEqual(node['slot'], slot)
+
+
+if __name__ == '__main__':
+    unittest.main()